@@ -5,28 +5,44 @@ from dotenv import load_dotenv
 # Load environment variables
 # -------------------------
 load_dotenv()
-import os
-from datetime import datetime
-from supabase import create_client
+from datetime import datetime, date
+from functools import lru_cache
 
 # -------------------------
 # Supabase setup
 # -------------------------
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+# Shared client (db.py), so main.py importing parse_birthdate adds no pool
+from db import supabase, SUPABASE_URL, SUPABASE_KEY
 
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Supabase URL or Key not found in environment variables.")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 # -------------------------
 # Helper to calculate age
 # -------------------------
+@lru_cache(maxsize=131072)
+def parse_birthdate(birthdate_str: str) -> date:
+    # Pure and low-cardinality, so parse each distinct birthdate only once.
+    # Also used by main.py for /natal ages.
+    s = birthdate_str
+    if len(s) == 10 and s[4] == "-" and s[7] == "-" and (s[:4] + s[5:7] + s[8:]).isdigit():
+        # Fixed YYYY-MM-DD shape: slice instead of going through strptime
+        return date(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+
+    # Try parsing using ISO or common patterns
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%m-%Y", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(s, fmt).date()
+        except ValueError:
+            pass
+
+    # As a last fallback
+    return datetime.fromisoformat(s).date()
+
 def calculate_age(birthdate_str):
     try:
-        birthdate = datetime.strptime(birthdate_str, "%Y-%m-%d")
-        today = datetime.today()
+        birthdate = parse_birthdate(birthdate_str)
+        today = date.today()
         age = today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
         return age
     except Exception as e:
@@ -0,0 +1,19 @@
+# batching.py
+# Small asyncio helpers shared by the in-process micro-batchers
+# (realtime_chat push/outbox queues, sana_psych_worker extractor).
+import asyncio
+
+async def drain_batch(queue: asyncio.Queue, max_items: int, interval: float) -> list:
+    # Wait for one item, then linger up to `interval` collecting up to max_items
+    loop = asyncio.get_running_loop()
+    batch = [await queue.get()]
+    deadline = loop.time() + interval
+    while len(batch) < max_items:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
@@ -5,9 +5,8 @@ from fastapi import HTTPException
 import swisseph as swe
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
-import asyncio
-from supabase import create_client
+from db import supabase
+from llm import aclient
 from dataclasses import dataclass
 
 # -------------------------
@@ -23,9 +22,6 @@ if not OPENAI_API_KEY:
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("Supabase URL or Key not found in .env")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 # -------------------------
 # Directories
 # -------------------------
@@ -91,8 +87,7 @@ async def geocode_with_openai(place: str):
 
     prompt = f"Return JSON with lat and lon for place: {place}"
     try:
-        resp = await asyncio.to_thread(
-            client.chat.completions.create,
+        resp = await aclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Provide only latitude and longitude in JSON."},
@@ -0,0 +1,114 @@
+# db.py
+# Shared Supabase clients. App modules import from here so the process keeps
+# one connection pool per key instead of one per module.
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import asyncio
+from typing import Optional
+
+import asyncpg
+import httpx
+import orjson
+from supabase import create_client, acreate_client, Client, ClientOptions, AsyncClient, AsyncClientOptions
+
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_KEY")
+
+# -------------------------
+# Sync clients
+# -------------------------
+# The anon client only talks to PostgREST, so it gets an explicit keep-alive
+# pool. postgrest/storage rewrite base_url and headers on an injected client,
+# which is why it is never shared with storage or with the service key.
+SUPABASE_HTTP_TIMEOUT = 10.0
+# httpx's default 5s idle expiry re-handshakes TLS after any short lull
+SUPABASE_KEEPALIVE_EXPIRY = 60.0
+
+_sync_http = httpx.Client(
+    timeout=SUPABASE_HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20,
+                        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY),
+)
+supabase: Client = create_client(
+    SUPABASE_URL, SUPABASE_KEY,
+    options=ClientOptions(httpx_client=_sync_http),
+)
+# service_role: writes that bypass RLS (device tokens, profile images, greetings).
+# It also uses storage, so each sub-client keeps its own (pooled) httpx session.
+supabase_service: Client = create_client(
+    SUPABASE_URL, SUPABASE_SERVICE_KEY,
+    options=ClientOptions(
+        postgrest_client_timeout=SUPABASE_HTTP_TIMEOUT,
+        storage_client_timeout=60,
+    ),
+)
+
+# -------------------------
+# Async client
+# -------------------------
+# Created on first use (the event loop does not exist at import time) and
+# shared by every async route; concurrency is bounded by the httpx pool.
+_async_supabase: Optional[AsyncClient] = None
+_async_http: Optional[httpx.AsyncClient] = None
+_async_lock = asyncio.Lock()
+
+async def get_async_supabase() -> AsyncClient:
+    global _async_supabase, _async_http
+    if _async_supabase is None:
+        async with _async_lock:
+            if _async_supabase is None:
+                _async_http = httpx.AsyncClient(
+                    timeout=30.0,
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50,
+                                        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY),
+                )
+                _async_supabase = await acreate_client(
+                    SUPABASE_URL, SUPABASE_KEY,
+                    options=AsyncClientOptions(httpx_client=_async_http),
+                )
+    return _async_supabase
+
+# -------------------------
+# Direct Postgres pool (optional)
+# -------------------------
+# With DATABASE_URL set, hot-path reads/writes skip the PostgREST hop and go
+# over asyncpg's binary protocol with prepared statements. Behind Supabase's
+# transaction pooler (port 6543) set DATABASE_STATEMENT_CACHE=0, since it
+# cannot keep prepared statements across transactions.
+DATABASE_URL = os.environ.get("DATABASE_URL")
+DATABASE_STATEMENT_CACHE = int(os.environ.get("DATABASE_STATEMENT_CACHE", "100"))
+
+_pg_pool: Optional[asyncpg.Pool] = None
+_pg_lock = asyncio.Lock()
+
+async def _init_pg_connection(conn: asyncpg.Connection):
+    # json/jsonb columns come back as Python objects, like they do from PostgREST
+    for typ in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typ, schema="pg_catalog",
+            encoder=lambda v: orjson.dumps(v).decode(), decoder=orjson.loads,
+        )
+
+async def get_pg_pool() -> Optional[asyncpg.Pool]:
+    global _pg_pool
+    if not DATABASE_URL:
+        return None
+    if _pg_pool is None:
+        async with _pg_lock:
+            if _pg_pool is None:
+                _pg_pool = await asyncpg.create_pool(
+                    DATABASE_URL, min_size=5, max_size=40,
+                    statement_cache_size=DATABASE_STATEMENT_CACHE,
+                    init=_init_pg_connection,
+                )
+    return _pg_pool
+
+async def close_supabase():
+    if _async_http is not None:
+        await _async_http.aclose()
+    if _pg_pool is not None:
+        await _pg_pool.close()
+    _sync_http.close()
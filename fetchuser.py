@@ -1,16 +1,11 @@
 from fastapi import APIRouter, HTTPException, Request, Query
 from pydantic import BaseModel
 from typing import Optional
-from supabase import create_client
-import os
+from db import supabase
 from datetime import datetime, timezone
 
 router = APIRouter()
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 class CheckUserPayload(BaseModel):
     id: Optional[str] = None
     email: Optional[str] = None
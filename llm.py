@@ -0,0 +1,119 @@
+# llm.py
+# Shared async OpenAI access. Calls are awaited directly on pooled keep-alive
+# connections instead of each taking a threadpool slot.
+import os
+import asyncio
+import logging
+from typing import List, Optional
+
+import aiohttp
+import httpx
+import orjson
+from openai import AsyncOpenAI
+
+log = logging.getLogger("sana-llm")
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# httpx drops idle connections after 5s by default, so a quiet few seconds
+# meant a fresh TLS handshake; keep them as long as the aiohttp pool does
+KEEPALIVE_EXPIRY = 75
+
+aclient = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100,
+                            keepalive_expiry=KEEPALIVE_EXPIRY),
+    ),
+)
+
+# -------------------------
+# Direct aiohttp transport (hot paths)
+# -------------------------
+# Non-streaming chat and embedding calls on the request path post straight to
+# the REST API over one aiohttp pool and read plain dicts back; streaming and
+# less common endpoints stay on the SDK client above.
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+_session: Optional[aiohttp.ClientSession] = None
+
+class OpenAIHTTPError(Exception):
+    def __init__(self, status: int, body: str):
+        super().__init__(f"OpenAI HTTP {status}: {body[:300]}")
+        self.status = status
+
+def get_session() -> aiohttp.ClientSession:
+    # Opened on first use so it binds to the running loop
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=200, limit_per_host=100, keepalive_timeout=KEEPALIVE_EXPIRY),
+            timeout=aiohttp.ClientTimeout(total=60),
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
+            json_serialize=lambda o: orjson.dumps(o).decode(),
+        )
+    return _session
+
+async def _post(path: str, payload: dict) -> dict:
+    async with get_session().post(f"{OPENAI_BASE_URL}{path}", json=payload) as r:
+        body = await r.read()
+        if r.status >= 400:
+            raise OpenAIHTTPError(r.status, body.decode(errors="replace"))
+        return orjson.loads(body)
+
+async def post_chat(payload: dict) -> dict:
+    return await _post("/chat/completions", payload)
+
+async def post_chat_text(payload: dict) -> str:
+    data = await post_chat(payload)
+    return data["choices"][0]["message"]["content"] or ""
+
+async def post_embedding(text: str, model: str = "text-embedding-3-small") -> List[float]:
+    data = await _post("/embeddings", {"model": model, "input": text})
+    return data["data"][0]["embedding"]
+
+# -------------------------
+# JSON in model output
+# -------------------------
+def extract_json_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} in text (string/escape aware), or None."""
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+async def async_retry(fn, *args, retries=3, backoff=0.4, **kwargs):
+    last_exc = None
+    for i in range(retries):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            last_exc = e
+            log.warning(f"Retry {i+1} failed: {e}")
+            if i + 1 < retries:
+                await asyncio.sleep(backoff * (2 ** i))
+    raise last_exc
+
+async def close_llm():
+    await aclient.close()
+    if _session is not None and not _session.closed:
+        await _session.close()
@@ -9,15 +9,17 @@ import json
 import asyncio
 from pathlib import Path
 from fastapi import FastAPI, HTTPException, APIRouter, BackgroundTasks
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel, validator
 import requests
 import httpx # Adding for async requests if needed, otherwise will use to_thread
 from datetime import datetime, date
 import swisseph as swe
-from openai import OpenAI
 
-# 3️⃣ Supabase import
-from supabase import create_client
+# 3️⃣ Supabase clients (shared, see db.py)
+from db import supabase, close_supabase
+from postgrest.exceptions import APIError
+from llm import aclient, close_llm
 
 # 4️⃣ Local imports
 from charts import calculate_chart, NatalData
@@ -30,9 +32,10 @@ from sana_psych_worker import router as psych_router
 from premium import premium_activate
 from save_user import router as save_user_router
 from routes import profile_image
-from realtime_chat import app as chat_app
+from realtime_chat import app as chat_app, close_push_session, flush_messages
 from sana_dynamic_greeting import router as sana_dynamic_greeting_router
 from update_device_token import router as update_device_token_router
+from agecalc import parse_birthdate
 
 # ---------------------------
 # Environment variables
@@ -44,10 +47,12 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("OpenAI API key not found. Set environment variable OPENAI_API_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_event_handler("shutdown", flush_messages)
+app.add_event_handler("shutdown", close_supabase)
+app.add_event_handler("shutdown", close_push_session)
+app.add_event_handler("shutdown", close_llm)
 
 # Global Error Handler to debug 500s
 from fastapi import Request
@@ -137,12 +142,11 @@ def home():
     return {"message": "✨ Anlasana backend is running 🚀"}
 
 # ---------------------------
-# OpenAI wrapper (sync -> async)
+# OpenAI wrapper
 # ---------------------------
 async def call_openai_async(prompt, system_msg):
     try:
-        resp = await asyncio.to_thread(
-            client.chat.completions.create,
+        resp = await aclient.chat.completions.create(
             model="gpt-5-nano",
             messages=[{"role":"system","content":system_msg},{"role":"user","content":prompt}],
             temperature=1
@@ -152,6 +156,43 @@ async def call_openai_async(prompt, system_msg):
     except Exception as e:
         return {"error": str(e)}
 
+def parse_mirror_line(line: str):
+    line = line.strip().strip(",").replace("```json", "").replace("```", "").strip()
+    if not line:
+        return None
+    try:
+        entry = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(entry, dict) and "title" in entry and "content" in entry:
+        return entry
+    return None
+
+async def stream_openai_ndjson(prompt, system_msg):
+    """Stream the completion and yield each mirror entry as soon as its line is complete."""
+    try:
+        stream = await aclient.chat.completions.create(
+            model="gpt-5-nano",
+            messages=[{"role":"system","content":system_msg},{"role":"user","content":prompt}],
+            temperature=1,
+            stream=True
+        )
+        buffer = ""
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            buffer += chunk.choices[0].delta.content or ""
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                entry = parse_mirror_line(line)
+                if entry:
+                    yield json.dumps(entry) + "\n"
+        entry = parse_mirror_line(buffer)
+        if entry:
+            yield json.dumps(entry) + "\n"
+    except Exception as e:
+        yield json.dumps({"error": str(e)}) + "\n"
+
 # ---------------------------
 # Supabase fetch
 # ---------------------------
@@ -191,18 +232,7 @@ def calculate_age_from_birthdate(birthdate: str | None) -> int | None:
             birthdate = str(birthdate)
 
         birthdate = birthdate.strip().strip('"').strip("'")
-
-        # Try parsing using ISO or common patterns
-        for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%m-%Y", "%Y-%m-%dT%H:%M:%S"):
-            try:
-                bd = datetime.strptime(birthdate, fmt)
-                break
-            except ValueError:
-                bd = None
-
-        if bd is None:
-            # As a last fallback
-            bd = datetime.fromisoformat(birthdate)
+        bd = parse_birthdate(birthdate)
 
         today = date.today()
         return today.year - bd.year - ((today.month, today.day) < (bd.month, bd.day))
@@ -211,28 +241,109 @@ def calculate_age_from_birthdate(birthdate: str | None) -> int | None:
         return None
 
 
-@router.post("/astro/full")
-async def get_full_chart(data: NatalData):
+# Only what the natal prompt reads; "*" also dragged psych_vector, memories,
+# psych_map etc. over the wire on every call
+NATAL_USER_COLUMNS = (
+    "id, name, age, birthdate, birthtime, birthplace, birth, chart, "
+    "moods, personality_traits, love_language, relationship_goals, interests"
+)
+
+# Postgres "relation does not exist" / PostgREST "table not in schema cache"
+MISSING_TABLE_CODES = ("42P01", "PGRST205")
+
+# Same depth the users.chat_history array used to be capped at
+NATAL_HISTORY_SIZE = 200
+
+def fetch_chat_history(user_id: str, limit: int = NATAL_HISTORY_SIZE) -> list:
+    """Last `limit` Sana chat messages, oldest first (sql/sana_chat_messages.sql)."""
+    try:
+        res = (
+            supabase.table("sana_chat_messages")
+            .select("role, name, content, time")
+            .eq("user_id", user_id)
+            .order("time", desc=True)
+            .order("id", desc=True)
+            .limit(limit)
+            .execute()
+        )
+        return list(reversed(res.data or []))
+    except APIError as e:
+        # Only a missing table means the history still lives on the users row;
+        # any other failure must not quietly serve the stale column
+        if e.code not in MISSING_TABLE_CODES:
+            raise
+        print(f"⚠️ sana_chat_messages not migrated, using users.chat_history: {e}")
+        res = supabase.table("users").select("chat_history").eq("id", user_id).execute()
+        return (res.data[0].get("chat_history") if res.data else None) or []
+
+_background_writes = set()
+
+async def save_profile_updates(user_id: str, updates: dict):
+    try:
+        await asyncio.to_thread(
+            lambda: supabase.table("users").update(updates).eq("id", user_id).execute()
+        )
+        print(f"✅ Saved {', '.join(updates)} for {user_id}")
+    except Exception as e:
+        print(f"⚠️ Failed to save {', '.join(updates)} for {user_id}: {e}")
+
+def save_profile_updates_in_background(user_id: str, updates: dict):
+    # Keep a reference so the task isn't garbage-collected mid-write
+    task = asyncio.create_task(save_profile_updates(user_id, updates))
+    _background_writes.add(task)
+    task.add_done_callback(_background_writes.discard)
+
+# Static system prompts, byte-identical on every call so OpenAI can reuse the
+# cached prefix; everything user-specific goes in the user message
+NATAL_INSTRUCTIONS = """
+You are Sana, playful female astrologer.
+If the birth place is in India, reply in English.
+otherwise, reply in the main language of that country.
+If unknown, reply in English.
+Avoid astrology jargon and planet names.
+Use simple, warm language — 1–2 lines each.
+Also, using user info (moods, personality, love language, goals, etc.), generate 5 self-understanding insights.
+Each entry must have: "title" and "content".
+"""
+NATAL_SYSTEM_JSON = (
+    "You are Sana, JSON only\n" + NATAL_INSTRUCTIONS
+    + "Return ONLY JSON with structure: {'mirror':[{'title':'...','content':'...'}]}\n"
+)
+NATAL_SYSTEM_NDJSON = (
+    "You are Sana, JSON lines only\n" + NATAL_INSTRUCTIONS
+    + "Return ONLY JSON lines: one {'title':'...','content':'...'} object per line, nothing else.\n"
+)
+
+async def build_natal_prompt(data: NatalData) -> str:
+    """Load the user, make sure their chart exists and build the Sana mirror prompt (without output format)."""
     # --- 1. Fetch user ---
+    # The profile and the chat history are separate tables; read both at once
     try:
-        resp = supabase.table("users").select("*").eq("id", data.id).single().execute()
+        resp, chat_history = await asyncio.gather(
+            asyncio.to_thread(
+                lambda: supabase.table("users").select(NATAL_USER_COLUMNS).eq("id", data.id).single().execute()
+            ),
+            asyncio.to_thread(fetch_chat_history, data.id)
+        )
         user = resp.data if resp and resp.data else None
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Supabase fetch error: {e}")
     if not user:
         raise HTTPException(status_code=404, detail=f"User {data.id} not found")
+    user["chat_history"] = chat_history
 
     
+    # Derived fields to write back; saved in one update that runs alongside the
+    # OpenAI call instead of blocking before it
+    profile_updates = {}
+
     birthdate = user.get("birthdate")
     if birthdate:
         age = calculate_age_from_birthdate(birthdate)
-        if age is not None:
+        # Only write when it changed (about once a year per user)
+        if age is not None and age != user.get("age"):
             user["age"] = age
-            try:
-               supabase.table("users").update({"age": age}).eq("id", user["id"]).execute()
-               print(f"✅ Age updated for {user['id']}: {age}")
-            except Exception as e:
-               print(f"⚠️ Failed to update age: {e}")
+            profile_updates["age"] = age
 
     # --- 2. Ensure birth data exists ---
     birth = user.get("birth")
@@ -249,7 +360,7 @@ async def get_full_chart(data: NatalData):
                 "minute": minute,
                 "place": bp
             }
-            supabase.table("users").update({"birth": birth}).eq("id", user["id"]).execute()
+            profile_updates["birth"] = birth
             user["birth"] = birth
         else:
             raise HTTPException(status_code=400, detail=f"Insufficient birth info for {user.get('name')}")
@@ -278,42 +389,50 @@ async def get_full_chart(data: NatalData):
                 pass
 
         astro_data = await calculate_chart(natal_data)
-        try:
-            supabase.table("users").update({"chart": json.dumps(astro_data)}).eq("id", user["id"]).execute()
-        except Exception as e:
-            print(f"⚠️ Failed to save chart for {user['id']}: {e}")
+        profile_updates["chart"] = json.dumps(astro_data)
         return astro_data
 
     astro_data = await load_or_generate_chart()
 
+    if profile_updates:
+        save_profile_updates_in_background(user["id"], profile_updates)
+
     # --- 7. Build OpenAI prompt ---
-    now_str = str(datetime.now())
+    # Only per-user data goes here; the instructions are the static
+    # NATAL_SYSTEM_* prefix
     natal_prompt = f"""
-Current date: {now_str}
-User chart: {json.dumps(astro_data)}
-You are Sana, playful female astrologer.
+Current date: {date.today().isoformat()}
 The user's birth place is: {natal_data.place}.
-If the birth place is in India, reply in English.
-otherwise, reply in the main language of that country.
-If unknown, reply in English.
+User chart: {json.dumps(astro_data)}
 User info: {user.get('chat_history')}, moods: {user.get('moods')}, personality: {user.get('personality_traits')},
 love language: {user.get('love_language')}, goals: {user.get('relationship_goals')}, interests: {user.get('interests')}
-Avoid astrology jargon and planet names.
-Use simple, warm language — 1–2 lines each.
-Also, using user info (moods, personality, love language, goals, etc.), generate 5 self-understanding insights.
-Each entry must have: "title" and "content".
-Return ONLY JSON with structure: {{'mirror':[{{'title':'...','content':'...'}}]}}
 """
+    return natal_prompt
+
+
+@router.post("/astro/full")
+async def get_full_chart(data: NatalData):
+    natal_prompt = await build_natal_prompt(data)
 
     # --- 8. Call OpenAI async ---
     try:
-        [natal_response] = await asyncio.gather(call_openai_async(natal_prompt, "You are Sana, JSON only"))
+        [natal_response] = await asyncio.gather(call_openai_async(natal_prompt, NATAL_SYSTEM_JSON))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Sana reflection failed: {e}")
 
     return {"natal": [{"mirror": natal_response.get("mirror", [])}]}
 
 
+@router.post("/astro/full/stream")
+async def stream_full_chart(data: NatalData):
+    """Same mirror as /astro/full, streamed as NDJSON: one {"title","content"} object per line."""
+    natal_prompt = await build_natal_prompt(data)
+    return StreamingResponse(
+        stream_openai_ndjson(natal_prompt, NATAL_SYSTEM_NDJSON),
+        media_type="application/x-ndjson"
+    )
+
+
 
 
 
@@ -4,18 +4,29 @@ from dotenv import load_dotenv
 load_dotenv()
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from supabase import create_client
-from datetime import datetime, timedelta
+from postgrest.exceptions import APIError
+from cachetools import TTLCache
+from db import get_async_supabase
+from datetime import datetime, timezone
+from types import MappingProxyType
 import os
 
 router = APIRouter()
 
 # -------------------------
-# Supabase setup
+# Supabase config (clients are shared, see db.py)
 # -------------------------
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# -------------------------
+# Premium tiers (read-only)
+# -------------------------
+TIER_MAPPING = MappingProxyType({
+    "basic": MappingProxyType({"price": 299, "days": 30, "badge": "basic"}),
+    "recommended": MappingProxyType({"price": 499, "days": 30, "badge": "recommended"}),
+    "elite": MappingProxyType({"price": 999, "days": 30, "badge": "elite"})
+})
 
 # -------------------------
 # Request model
@@ -28,47 +39,31 @@ class PremiumRequest(BaseModel):
 # Activate Premium endpoint
 # -------------------------
 @router.post("/activate")
-def activate_premium(data: PremiumRequest):
-    # 1️⃣ Fetch user data safely
-    user_res = supabase.table("users").select("id, name, email").eq("id", data.user_id).maybe_single().execute()
-    if not user_res or not getattr(user_res, "data", None):
-        raise HTTPException(status_code=404, detail="User not found")
-    user = user_res.data
-
-    # 2️⃣ Check if already premium safely
-    existing_res = supabase.table("premium_users").select("id").eq("user_id", data.user_id).maybe_single().execute()
-    if existing_res and getattr(existing_res, "data", None):
-        raise HTTPException(status_code=400, detail="User already has premium")
-
-    # 3️⃣ Define premium period & price
-    tier_mapping = {
-        "basic": {"price": 299, "days": 30, "badge": "basic"},
-        "recommended": {"price": 499, "days": 30, "badge": "recommended"},
-        "elite": {"price": 999, "days": 30, "badge": "elite"}
-    }
+async def activate_premium(data: PremiumRequest):
+    supabase = await get_async_supabase()
 
+    # 1️⃣ Resolve premium period & price
     tier = data.premium_type.lower()
-    if tier not in tier_mapping:
-        raise HTTPException(status_code=400, detail=f"Invalid premium type. Choose from: {list(tier_mapping.keys())}")
-
-    price = tier_mapping[tier]["price"]
-    duration_days = tier_mapping[tier]["days"]
-    badge = tier_mapping[tier]["badge"]
-
-    start_date = datetime.utcnow().isoformat()
-    end_date = (datetime.utcnow() + timedelta(days=duration_days)).isoformat()
-
-    # 4️⃣ Insert into premium_users safely
-    insert_res = supabase.table("premium_users").insert({
-        "user_id": data.user_id,
-        "name": user.get("name"),
-        "email": user.get("email"),
-        "premium_type": data.premium_type,
-        "start_date": start_date,
-        "end_date": end_date,
-        "price": price,
-        "badge": badge
-    }).execute()
+    if tier not in TIER_MAPPING:
+        raise HTTPException(status_code=400, detail=f"Invalid premium type. Choose from: {list(TIER_MAPPING.keys())}")
+
+    # 2️⃣ Lookup, duplicate check and insert in one atomic RPC (sql/activate_premium.sql)
+    try:
+        insert_res = await supabase.rpc("activate_premium", {
+            "p_user_id": data.user_id,
+            "p_premium_type": data.premium_type,
+            "p_price": TIER_MAPPING[tier]["price"],
+            "p_days": TIER_MAPPING[tier]["days"],
+            "p_badge": TIER_MAPPING[tier]["badge"]
+        }).execute()
+    except APIError as e:
+        if e.code == "P0002":
+            raise HTTPException(status_code=404, detail="User not found")
+        if e.code == "23505":
+            raise HTTPException(status_code=400, detail="User already has premium")
+        raise
+
+    _status_cache.pop(data.user_id, None)
 
     return {
         "message": "Premium activated successfully 🌟",
@@ -76,75 +71,81 @@ def activate_premium(data: PremiumRequest):
     }
 
 # -------------------------
-# Check Premium Status endpoint
+# Premium status (cached)
 # -------------------------
+# Clients poll /status; each result is kept for STATUS_CACHE_TTL seconds and
+# dropped as soon as the user activates premium.
+STATUS_CACHE_TTL = 60
+_status_cache = TTLCache(maxsize=10_000, ttl=STATUS_CACHE_TTL)
+
+async def _status_cached(user_id: str) -> dict:
+    status = _status_cache.get(user_id)
+    if status is None:
+        status = await _fetch_status(user_id)
+        _status_cache[user_id] = status
+    return status
+
+async def _fetch_status(user_id: str) -> dict:
+    supabase = await get_async_supabase()
+
+    # 1️⃣ Fetch from premium_users
+    res = await supabase.table("premium_users").select("*").eq("user_id", user_id).maybe_single().execute()
+
+    if not res or not getattr(res, "data", None):
+        # No premium record found -> Free user
+        return {
+            "is_premium": False,
+            "premium_type": "free",
+            "badge": "none",
+            "days_remaining": 0,
+            "end_date": None,
+            "message": "No active premium subscription found."
+        }
+
+    data = res.data
+    end_date_str = data.get("end_date")
+
+    if not end_date_str:
+         return {
+            "is_premium": False,
+            "premium_type": "free",
+            "badge": "none",
+            "days_remaining": 0,
+            "end_date": None,
+            "message": "Invalid subscription data (no end date)."
+        }
+
+    # 2️⃣ Calculate days remaining (all in aware UTC; older rows were written naive UTC)
+    end_date = datetime.fromisoformat(end_date_str.replace("Z", "+00:00"))
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=timezone.utc)
+
+    now = datetime.now(timezone.utc)
+    remaining = (end_date - now).days
+
+    is_active = remaining > 0
+
+    return {
+        "is_premium": is_active,
+        "premium_type": data.get("premium_type", "unknown") if is_active else "expired",
+        "badge": data.get("badge", "soulmate") if is_active else "none",
+        "days_remaining": max(0, remaining),
+        "end_date": end_date_str,
+        "message": "Active subscription found." if is_active else "Subscription has expired."
+    }
+
 # -------------------------
 # Check Premium Status endpoint
 # -------------------------
 @router.get("/status/{user_id}")
-def get_premium_status(user_id: str):
+async def get_premium_status(user_id: str):
     try:
         # Debugging: Ensure env vars are loaded
         if not SUPABASE_URL or not SUPABASE_KEY:
              print("❌ SUPABASE_URL or SUPABASE_KEY missing in premium_activate.py")
              raise HTTPException(status_code=500, detail="Server configuration error: Missing Supabase credentials")
 
-        # 1️⃣ Fetch from premium_users
-        res = supabase.table("premium_users").select("*").eq("user_id", user_id).maybe_single().execute()
-        
-        if not res or not getattr(res, "data", None):
-            # No premium record found -> Free user
-            return {
-                "is_premium": False,
-                "premium_type": "free",
-                "badge": "none",
-                "days_remaining": 0,
-                "end_date": None,
-                "message": "No active premium subscription found."
-            }
-        
-        data = res.data
-        end_date_str = data.get("end_date")
-        
-        if not end_date_str:
-             return {
-                "is_premium": False,
-                "premium_type": "free",
-                "badge": "none",
-                "days_remaining": 0,
-                "end_date": None,
-                "message": "Invalid subscription data (no end date)."
-            }
-
-        # 2️⃣ Calculate days remaining
-        
-        # Handle 'Z' manually if python < 3.11 for isoformat mostly loves it, but be safe
-        # replace("Z", "+00:00") is standard fix for fromisoformat
-        clean_date_str = end_date_str.replace("Z", "+00:00")
-        end_date = datetime.fromisoformat(clean_date_str)
-        
-        # Use utcnow to compare
-        now = datetime.utcnow().replace(tzinfo=None) # naive
-        # end_date from isoformat might have timezone if +00:00 was there
-        
-        if end_date.tzinfo is not None:
-             # Convert to naive UTC for comparison or make 'now' aware
-             # Easier: make now aware
-             from datetime import timezone
-             now = datetime.now(timezone.utc)
-        
-        remaining = (end_date - now).days
-        
-        is_active = remaining > 0
-        
-        return {
-            "is_premium": is_active,
-            "premium_type": data.get("premium_type", "unknown") if is_active else "expired",
-            "badge": data.get("badge", "soulmate") if is_active else "none",
-            "days_remaining": max(0, remaining),
-            "end_date": end_date_str,
-            "message": "Active subscription found." if is_active else "Subscription has expired."
-        }
+        return await _status_cached(user_id)
     except Exception as e:
         print(f"🔥 Error in get_premium_status: {str(e)}")
         import traceback
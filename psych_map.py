@@ -0,0 +1,12 @@
+# psych_map.py
+# Helpers for users.psych_map, shared by the psych worker and /sana/chat.
+# Entries are {"value", "confidence", "history"}; history (timestamped
+# observations) is kept for storage only.
+from typing import Any, Dict
+
+def trait_values(psych_map: Dict[str, Any]) -> Dict[str, Any]:
+    """psych_map without per-trait history: what prompts and embeddings should see."""
+    return {
+        k: {"value": e.get("value"), "confidence": e.get("confidence")} if isinstance(e, dict) else e
+        for k, e in (psych_map or {}).items()
+    }
@@ -1,16 +1,26 @@
 # server.py
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from supabase import create_client, Client
+from fastapi.responses import ORJSONResponse
+from supabase import AsyncClient
+from db import supabase, get_async_supabase
+from batching import drain_batch
 import traceback
-import os, json
-import requests
+import base64
+from typing import Optional
+import os
+import asyncio
+import threading
+import aiohttp
+from datetime import datetime, timezone
 from google.oauth2 import service_account
 import google.auth.transport.requests
-import io
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+import orjson
 
 # -------------------- SETUP --------------------
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,30 +30,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 FCM_SERVICE_ACCOUNT_JSON = os.getenv("FCM_SERVICE_ACCOUNT_JSON")  # JSON as one-line env var
 PROJECT_ID = os.getenv("FIREBASE_PROJECT_ID")  # Firebase project ID
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-connected_users = {}  # { user_id: websocket }
+REDIS_URL = os.getenv("REDIS_URL")  # optional, enables cross-worker delivery
+
+connected_users = {}  # { user_id: websocket } for sockets on THIS worker
 
 # -------------------- FCM PUSH (HTTP v1 API) --------------------
+# The service account is parsed once at import. The OAuth token is good for
+# ~1h; reuse it and only refresh when google-auth reports it expired (or about
+# to). Valid tokens are returned without taking the lock; the lock only keeps
+# concurrent pushes from all refreshing at once.
+FCM_SCOPES = ["https://www.googleapis.com/auth/firebase.messaging"]
+
+def load_fcm_credentials():
+    if not FCM_SERVICE_ACCOUNT_JSON:
+        return None
+    try:
+        return service_account.Credentials.from_service_account_info(
+            orjson.loads(FCM_SERVICE_ACCOUNT_JSON), scopes=FCM_SCOPES
+        )
+    except Exception as e:
+        print(f"❌ Invalid FCM_SERVICE_ACCOUNT_JSON: {e}")
+        return None
+
+_fcm_credentials = load_fcm_credentials()
+_fcm_lock = threading.Lock()
+
 def get_fcm_access_token():
-    # Load service account from environment variable
-    json_file = io.StringIO(FCM_SERVICE_ACCOUNT_JSON)
-    credentials = service_account.Credentials.from_service_account_info(
-        json.load(json_file),
-        scopes=["https://www.googleapis.com/auth/firebase.messaging"]
-    )
-    request = google.auth.transport.requests.Request()
-    credentials.refresh(request)
-    return credentials.token
-
-def send_push_notification(device_token: str, title: str, body: str):
+    if _fcm_credentials is None:
+        raise RuntimeError("FCM_SERVICE_ACCOUNT_JSON is not configured")
+    if _fcm_credentials.valid:
+        return _fcm_credentials.token
+    with _fcm_lock:
+        if not _fcm_credentials.valid:
+            _fcm_credentials.refresh(google.auth.transport.requests.Request())
+        return _fcm_credentials.token
+
+# One aiohttp session per process, opened on first push (this app is mounted,
+# so its startup events never fire).
+_push_session = None
+
+async def get_push_session() -> aiohttp.ClientSession:
+    global _push_session
+    if _push_session is None or _push_session.closed:
+        _push_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    return _push_session
+
+async def close_push_session():
+    if _push_session is not None and not _push_session.closed:
+        await _push_session.close()
+
+async def send_push_notification(device_token: str, title: str, body: str, access_token: str = None):
     if not device_token:
         return
-    access_token = get_fcm_access_token()
+    if access_token is None:
+        access_token = await asyncio.to_thread(get_fcm_access_token)
     url = f"https://fcm.googleapis.com/v1/projects/{PROJECT_ID}/messages:send"
     message = {
         "message": {
@@ -57,99 +100,411 @@ def send_push_notification(device_token: str, title: str, body: str):
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json; UTF-8"
     }
-    response = requests.post(url, headers=headers, json=message)
-    print("📨 Push result:", response.text)
+    session = await get_push_session()
+    async with session.post(url, headers=headers, json=message) as response:
+        print("📨 Push result:", await response.text())
+
+# -------------------- PUSH QUEUE --------------------
+# Offline notifications are coalesced: one users lookup per batch for every
+# receiver and sender involved, then all FCM requests are sent concurrently.
+PUSH_BATCH_SIZE = 100
+PUSH_FLUSH_INTERVAL = 0.05  # seconds
+PUSH_QUEUE_SIZE = 1000
+
+_push_queue: asyncio.Queue = asyncio.Queue(maxsize=PUSH_QUEUE_SIZE)
+_push_worker_task = None
+
+# Display names rarely change, so senders are resolved from a short-lived
+# cache. Receivers' device tokens are cached for a shorter window so repeat
+# pushes to the same offline peer skip the users lookup. Profile and token
+# writes call invalidate_user_cache.
+SENDER_NAME_TTL = 300  # seconds
+DEVICE_TOKEN_TTL = 60  # seconds
+_sender_names = TTLCache(maxsize=10_000, ttl=SENDER_NAME_TTL)
+_device_tokens = TTLCache(maxsize=100_000, ttl=DEVICE_TOKEN_TTL)
+
+def invalidate_user_cache(user_id: str):
+    _sender_names.pop(user_id, None)
+    _device_tokens.pop(user_id, None)
+
+def fetch_push_users(user_ids: list) -> dict:
+    res = supabase.table("users").select("id, device_token, name").in_("id", user_ids).execute()
+    return {u["id"]: u for u in (res.data or [])}
+
+async def send_push_batch(batch: list):
+    lookup = {r for r, _, _ in batch if r not in _device_tokens} | \
+             {s for _, s, _ in batch if s not in _sender_names}
+    if lookup:
+        users = await asyncio.to_thread(fetch_push_users, list(lookup))
+        for uid, u in users.items():
+            _sender_names[uid] = u.get("name") or "Someone"
+            _device_tokens[uid] = u.get("device_token")
+    names = {s: _sender_names.get(s, "Someone") for _, s, _ in batch}
+    tokens = {r: _device_tokens.get(r) for r, _, _ in batch}
+
+    pending = [(receiver_id, sender_id, content) for receiver_id, sender_id, content in batch
+               if tokens[receiver_id]]
+    if not pending:
+        return
+
+    access_token = await asyncio.to_thread(get_fcm_access_token)
+    results = await asyncio.gather(*[
+        send_push_notification(
+            device_token=tokens[receiver_id],
+            title=f"💌 New message from {names[sender_id]}",
+            body=content,
+            access_token=access_token
+        )
+        for receiver_id, sender_id, content in pending
+    ], return_exceptions=True)
+    for (receiver_id, _, _), result in zip(pending, results):
+        if isinstance(result, Exception):
+            print(f"❌ Push to {receiver_id} failed: {result}")
+
+async def push_worker():
+    while True:
+        batch = await drain_batch(_push_queue, PUSH_BATCH_SIZE, PUSH_FLUSH_INTERVAL)
+        try:
+            await send_push_batch(batch)
+        except Exception as e:
+            print(f"❌ Failed to send {len(batch)} pushes: {e}")
+
+def queue_push(receiver_id: str, sender_id: str, content: str):
+    global _push_worker_task
+    if _push_worker_task is None or _push_worker_task.done():
+        _push_worker_task = asyncio.create_task(push_worker())
+    try:
+        _push_queue.put_nowait((receiver_id, sender_id, content))
+    except asyncio.QueueFull:
+        # Pushes are best effort; never hold up the chat loop for one
+        print(f"⚠️ Push queue full, dropping notification for {receiver_id}")
+
+# -------------------- MESSAGE WRITER --------------------
+# Chat frames are persisted by one background writer that batches inserts,
+# so the websocket loop never waits on a Supabase round trip.
+MESSAGE_BATCH_SIZE = 100
+MESSAGE_FLUSH_INTERVAL = 0.05  # seconds
+MESSAGE_INSERT_RETRIES = 3
+MESSAGE_SHUTDOWN_TIMEOUT = 10  # seconds
+# Bounded so a stalled database applies backpressure to senders instead of
+# growing memory without limit
+MESSAGE_OUTBOX_SIZE = 1000
+
+_message_outbox: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_OUTBOX_SIZE)
+_message_writer_task = None
+_message_shutdown = False  # set by flush_messages; later rows skip the outbox
+
+def insert_messages(rows):
+    supabase.table("messages").insert(rows).execute()
+
+async def save_batch(batch: list):
+    for attempt in range(MESSAGE_INSERT_RETRIES):
+        try:
+            await asyncio.to_thread(insert_messages, batch)
+            return
+        except Exception as e:
+            print(f"⚠️ Saving {len(batch)} messages failed (attempt {attempt + 1}): {e}")
+            if attempt + 1 < MESSAGE_INSERT_RETRIES:
+                await asyncio.sleep(0.5 * 2 ** attempt)
+    print(f"❌ Dropped {len(batch)} messages after {MESSAGE_INSERT_RETRIES} attempts")
+
+async def message_writer():
+    while True:
+        batch = await drain_batch(_message_outbox, MESSAGE_BATCH_SIZE, MESSAGE_FLUSH_INTERVAL)
+        # None is the shutdown marker queued by flush_messages. Rows can still
+        # sit behind it (senders blocked on a full outbox), so once it is seen
+        # keep draining until the outbox is empty.
+        stop = None in batch
+        if stop:
+            batch = [row for row in batch if row is not None]
+            while not _message_outbox.empty():
+                row = _message_outbox.get_nowait()
+                if row is not None:
+                    batch.append(row)
+        for i in range(0, len(batch), MESSAGE_BATCH_SIZE):
+            await save_batch(batch[i:i + MESSAGE_BATCH_SIZE])
+        if stop:
+            return
+
+async def flush_messages():
+    # Shutdown: let the writer save everything queued so far, then stop
+    global _message_shutdown
+    _message_shutdown = True
+    if _message_writer_task is None or _message_writer_task.done():
+        return
+    await _message_outbox.put(None)
+    try:
+        await asyncio.wait_for(_message_writer_task, MESSAGE_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"❌ Message writer did not finish within {MESSAGE_SHUTDOWN_TIMEOUT}s; "
+              f"{_message_outbox.qsize()} messages unsaved")
+        return
+    # Senders that were blocked on the full outbox complete their put only
+    # after the writer's last drain woke them; save those rows too
+    await asyncio.sleep(0)
+    while not _message_outbox.empty():
+        batch = []
+        while not _message_outbox.empty() and len(batch) < MESSAGE_BATCH_SIZE:
+            batch.append(_message_outbox.get_nowait())
+        await save_batch(batch)
+        await asyncio.sleep(0)
+
+async def queue_message(row: dict):
+    # Started lazily: this app is mounted, so its startup events never fire
+    global _message_writer_task
+    if _message_shutdown:
+        # The writer is stopping and would never see this row
+        await save_batch([row])
+        return
+    if _message_writer_task is None or _message_writer_task.done():
+        _message_writer_task = asyncio.create_task(message_writer())
+    await _message_outbox.put(row)
+
+# -------------------- REDIS FANOUT --------------------
+# With several workers/pods a receiver may be connected elsewhere. Each worker
+# subscribes to chat:user:{id} for its own sockets; senders publish there when
+# the receiver is not local. PUBLISH returns the number of subscribers, so 0
+# means the receiver is offline everywhere and gets a push instead.
+# One bounded pool per worker shared by publishes and the pub/sub listener;
+# when all connections are busy callers wait briefly instead of erroring.
+REDIS_MAX_CONNECTIONS = 20
+
+redis_pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=5, decode_responses=True
+) if REDIS_URL else None
+redis_client = aioredis.Redis(connection_pool=redis_pool) if redis_pool else None
+_pubsub = None
+_fanout_task = None
+
+def user_channel(user_id: str) -> str:
+    return f"chat:user:{user_id}"
+
+async def fanout_listener():
+    while True:
+        try:
+            if not _pubsub.subscribed:
+                await asyncio.sleep(1.0)
+                continue
+            item = await _pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        except Exception as e:
+            print(f"⚠️ Redis fanout error: {e}")
+            await asyncio.sleep(1.0)
+            continue
+        if not item:
+            continue
+
+        user_id = item["channel"].split(":", 2)[2]
+        ws = connected_users.get(user_id)
+        if ws:
+            try:
+                await ws.send_text(item["data"])
+            except Exception as e:
+                print(f"⚠️ Fanout delivery to {user_id} failed: {e}")
+
+async def subscribe_user(user_id: str):
+    global _pubsub, _fanout_task
+    if not redis_client:
+        return
+    try:
+        if _pubsub is None:
+            _pubsub = redis_client.pubsub()
+        await _pubsub.subscribe(user_channel(user_id))
+        if _fanout_task is None or _fanout_task.done():
+            _fanout_task = asyncio.create_task(fanout_listener())
+    except Exception as e:
+        print(f"⚠️ Redis subscribe failed for {user_id}: {e}")
+
+async def unsubscribe_user(user_id: str):
+    if not redis_client or _pubsub is None:
+        return
+    try:
+        await _pubsub.unsubscribe(user_channel(user_id))
+    except Exception as e:
+        print(f"⚠️ Redis unsubscribe failed for {user_id}: {e}")
+
+async def publish_to_user(user_id: str, data: str) -> bool:
+    """Deliver via another worker; False when nobody is subscribed."""
+    if not redis_client:
+        return False
+    try:
+        return await redis_client.publish(user_channel(user_id), data) > 0
+    except Exception as e:
+        print(f"⚠️ Redis publish failed for {user_id}: {e}")
+        return False
 
 # -------------------- WEBSOCKET --------------------
 @app.websocket("/ws/{user_id}")
 async def chat_socket(websocket: WebSocket, user_id: str):
     await websocket.accept()
     connected_users[user_id] = websocket
+    await subscribe_user(user_id)
     print(f"✅ User connected: {user_id}")
 
     try:
         while True:
             data = await websocket.receive_text()
-            message = json.loads(data)
-
-            # Save message to Supabase
-            supabase.table("messages").insert({
-                "sender_id": message["sender_id"],
-                "receiver_id": message["receiver_id"],
-                "content": message["content"]
-            }).execute()
+            message = orjson.loads(data)
+            received_at = datetime.now(timezone.utc).isoformat()
 
             receiver_id = message["receiver_id"]
             receiver_ws = connected_users.get(receiver_id)
 
+            # Deliver first so the receiver never waits on the database write;
+            # the raw frame is forwarded as-is, no re-encode
+            delivered = False
             if receiver_ws:
-                await receiver_ws.send_text(json.dumps(message))
+                try:
+                    await receiver_ws.send_text(data)
+                    delivered = True
+                except Exception as e:
+                    print(f"⚠️ Live delivery to {receiver_id} failed, falling back to push: {e}")
+                    if connected_users.get(receiver_id) is receiver_ws:
+                        connected_users.pop(receiver_id, None)
             else:
-                res = supabase.table("users").select("device_token, name").eq("id", receiver_id).execute()
-                if res.data:
-                    device_token = res.data[0].get("device_token")
-                    sender_res = supabase.table("users").select("name").eq("id", message["sender_id"]).execute()
-                    sender_name = sender_res.data[0]["name"] if sender_res.data else "Someone"
-                    send_push_notification(
-                        device_token=device_token,
-                        title=f"💌 New message from {sender_name}",
-                        body=message["content"]
-                    )
+                delivered = await publish_to_user(receiver_id, data)
+
+            # Queue message for the batched Supabase writer. created_at is the
+            # arrival time so rows flushed in the same batch keep their order.
+            await queue_message({
+                "sender_id": message["sender_id"],
+                "receiver_id": receiver_id,
+                "content": message["content"],
+                "created_at": received_at
+            })
+
+            if not delivered:
+                # Fire-and-forget: the receive loop never waits on FCM
+                queue_push(receiver_id, message["sender_id"], message["content"])
 
     except WebSocketDisconnect:
         print(f"❌ User disconnected: {user_id}")
     finally:
-        connected_users.pop(user_id, None)
+        # A reconnect may already have replaced this socket
+        if connected_users.get(user_id) is websocket:
+            connected_users.pop(user_id, None)
+            await unsubscribe_user(user_id)
+
+# -------------------- Get messages (paginated) --------------------
+MESSAGES_PAGE_LIMIT = 200
+
+def conversation_key(user1: str, user2: str) -> str:
+    # Must match the generated messages.conversation_id (sql/messages_conversation_id.sql)
+    return f"{min(user1, user2)}_{max(user1, user2)}"
+
+# The cursor is opaque URL-safe base64 of {created_at, id}, so the "+" and ":"
+# in the timestamp survive clients that don't URL-encode it. id breaks ties
+# between rows sharing a timestamp (batched inserts).
+def encode_message_cursor(row: dict) -> str:
+    raw = orjson.dumps({"created_at": row["created_at"], "id": str(row["id"])})
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_message_cursor(cursor: str) -> tuple:
+    try:
+        raw = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(raw["created_at"]), str(raw["id"])
+    except (ValueError, TypeError, KeyError):
+        pass
+    try:
+        # Bare created_at from clients that predate the opaque cursor
+        datetime.fromisoformat(cursor)
+        return cursor, None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def cursor_filter(before: str) -> str:
+    created_at, msg_id = decode_message_cursor(before)
+    if msg_id is None:
+        return f'created_at.lt."{created_at}"'
+    return f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{msg_id}")'
 
-# -------------------- Get all messages --------------------
 @app.get("/get_messages")
-async def get_messages(user1: str = Query(...), user2: str = Query(...)):
+async def get_messages(
+    user1: str = Query(...),
+    user2: str = Query(...),
+    before: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=MESSAGES_PAGE_LIMIT),
+    db: AsyncClient = Depends(get_async_supabase),
+):
+    # Newest page first; pass next_cursor back as `before` to load older history
+    after_cursor = cursor_filter(before) if before else None
+
+    def page_query(use_conversation_id: bool):
+        query = db.table("messages").select("*")
+        if use_conversation_id:
+            query = query.eq("conversation_id", conversation_key(user1, user2))
+            if after_cursor:
+                query = query.or_(after_cursor)
+        else:
+            # One OR tree, so the cursor is ANDed into each direction
+            cursor_cond = f",or({after_cursor})" if after_cursor else ""
+            or_filter = (
+                f"and(sender_id.eq.{user1},receiver_id.eq.{user2}{cursor_cond}),"
+                f"and(sender_id.eq.{user2},receiver_id.eq.{user1}{cursor_cond})"
+            )
+            query = query.or_(or_filter)
+        return query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1)
+
     try:
-        or_filter = f"and(sender_id.eq.{user1},receiver_id.eq.{user2}),and(sender_id.eq.{user2},receiver_id.eq.{user1})"
-        result = supabase.table("messages").select("*").or_(or_filter).order("created_at").execute()
-        return {"messages": result.data or []}
+        try:
+            result = await page_query(True).execute()
+        except Exception as e:
+            print(f"⚠️ conversation_id lookup failed, using sender/receiver filter: {e}")
+            result = await page_query(False).execute()
+        rows = result.data or []
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()  # client renders oldest -> newest
+        next_cursor = encode_message_cursor(rows[0]) if has_more and rows else None
+        return {"messages": rows, "next_cursor": next_cursor}
     except Exception as e:
         return {"error": str(e)}
 
 # -------------------- Get user chat previews --------------------
+async def build_chat_previews(db: AsyncClient, user_id: str) -> list:
+    # Fallback when the get_user_chat_previews RPC is unavailable
+    messages_resp = await db.table("messages") \
+        .select("sender_id, receiver_id, content") \
+        .or_(f"sender_id.eq.{user_id},receiver_id.eq.{user_id}") \
+        .order("created_at", desc=True) \
+        .execute()
+    messages = messages_resp.data or []
+
+    # 1. One pass: newest message per soulmate (rows are newest first)
+    chat_dict = {}
+    for msg in messages:
+        from_self = msg["sender_id"] == user_id
+        soulmate_id = msg["receiver_id"] if from_self else msg["sender_id"]
+        if soulmate_id not in chat_dict:
+            chat_dict[soulmate_id] = {
+                "soulmate_id": soulmate_id,
+                "soulmate_name": "Unknown",
+                "last_message": msg["content"],
+                "from_self": from_self,
+                "profile_url": None
+            }
+
+    # 2. Batch fetch user details in ONE query and fill them in
+    if chat_dict:
+        users_resp = await db.table("users").select("id, name, profilePicUrl").in_("id", list(chat_dict)).execute()
+        for u in (users_resp.data or []):
+            chat = chat_dict[u["id"]]
+            chat["soulmate_name"] = u.get("name", "Unknown")
+            chat["profile_url"] = u.get("profilePicUrl")
+
+    return list(chat_dict.values())
+
 @app.get("/get_user_chats")
-async def get_user_chats(user_id: str = Query(...)):
+async def get_user_chats(user_id: str = Query(...), db: AsyncClient = Depends(get_async_supabase)):
     try:
-        messages_resp = supabase.table("messages") \
-            .select("*") \
-            .or_(f"sender_id.eq.{user_id},receiver_id.eq.{user_id}") \
-            .order("created_at", desc=True) \
-            .execute()
-        messages = messages_resp.data or []
-
-        # 1. Identify all unique soulmate IDs
-        soulmate_ids = set()
-        for msg in messages:
-            sid = msg["receiver_id"] if msg["sender_id"] == user_id else msg["sender_id"]
-            soulmate_ids.add(sid)
-
-        # 2. Batch fetch user details in ONE query
-        user_map = {}
-        if soulmate_ids:
-            users_resp = supabase.table("users").select("id, name, profilePicUrl").in_("id", list(soulmate_ids)).execute()
-            for u in (users_resp.data or []):
-                user_map[u["id"]] = u
-
-        # 3. Build chat previews
-        chat_dict = {}
-        for msg in messages:
-            soulmate_id = msg["receiver_id"] if msg["sender_id"] == user_id else msg["sender_id"]
-            if soulmate_id not in chat_dict:
-                user_data = user_map.get(soulmate_id, {})
-                chat_dict[soulmate_id] = {
-                    "soulmate_id": soulmate_id,
-                    "soulmate_name": user_data.get("name", "Unknown"),
-                    "last_message": msg["content"],
-                    "from_self": msg["sender_id"] == user_id,
-                    "profile_url": user_data.get("profilePicUrl")
-                }
-
-        return {"chats": list(chat_dict.values())}
+        # One row per conversation, computed in Postgres (sql/get_user_chat_previews.sql)
+        try:
+            res = await db.rpc("get_user_chat_previews", {"uid": user_id}).execute()
+            return {"chats": res.data or []}
+        except Exception as e:
+            print(f"⚠️ get_user_chat_previews RPC failed, building previews in Python: {e}")
+
+        return {"chats": await build_chat_previews(db, user_id)}
     except Exception as e:
         print("Error in /get_user_chats:")
         traceback.print_exc()
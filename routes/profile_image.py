@@ -2,46 +2,131 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from fastapi import APIRouter, UploadFile, Form, HTTPException
-from supabase import create_client
+from db import supabase_service as supabase, SUPABASE_URL, SUPABASE_SERVICE_KEY  # service role key
+from typing import Optional
 import os, mimetypes
+import logging
+import logging.handlers
+import queue
+import asyncio
+import httpx
 
 router = APIRouter()
 
-# -------------------------
-# Supabase setup (use SERVICE ROLE key)
-# -------------------------
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")  # <-- make sure this is service role key
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-
 BUCKET = "profile-pics"
 
 # -------------------------
-# Debug helper
+# Logging
 # -------------------------
-def debug(msg, data=None):
-    if data is not None:
-        print(f"🔹 DEBUG: {msg} -> {data}")
-    else:
-        print(f"🔹 DEBUG: {msg}")
+# Per-upload detail is DEBUG and skipped (no formatting) at the default
+# WARNING level; set PROFILE_IMAGE_LOG_LEVEL=DEBUG to see it. Records go
+# through a queue so a slow stdout never blocks the request handler.
+log = logging.getLogger("sana-profile-image")
+log.setLevel(os.getenv("PROFILE_IMAGE_LOG_LEVEL", "WARNING").upper())
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
 
 # -------------------------
 # Ensure bucket exists
 # -------------------------
+# Checked once at startup; uploads only retry it if that check failed.
+_bucket_checked = False
+
 def ensure_bucket_exists():
+    global _bucket_checked
     try:
         buckets = supabase.storage.list_buckets()
         bucket_names = [b['name'] for b in buckets]
-        debug("Existing buckets", bucket_names)
+        log.debug("Existing buckets -> %s", bucket_names)
 
         if BUCKET not in bucket_names:
-            debug("Creating bucket", BUCKET)
+            log.info("Creating bucket %s", BUCKET)
             supabase.storage.create_bucket(BUCKET, {"public": True})
-            debug("✅ Created bucket", BUCKET)
+            log.info("✅ Created bucket %s", BUCKET)
         else:
-            debug("✅ Bucket exists", BUCKET)
+            log.debug("✅ Bucket exists %s", BUCKET)
+        _bucket_checked = True
     except Exception as e:
-        debug("⚠ Bucket check failed", str(e))
+        log.warning("⚠ Bucket check failed: %s", e)
+
+@router.on_event("startup")
+def ensure_bucket_on_startup():
+    ensure_bucket_exists()
+
+# -------------------------
+# Object name / public URL
+# -------------------------
+def profile_object_name(user_id: str, original_filename: str) -> str:
+    ext = os.path.splitext(original_filename or "")[1] or ".png"
+    return f"profile_{user_id}{ext}"
+
+def public_object_url(filename: str) -> str:
+    # Same address get_public_url builds, without going through the SDK
+    return f"{SUPABASE_URL.rstrip('/')}/storage/v1/object/public/{BUCKET}/{filename}"
+
+# -------------------------
+# Streaming storage upload
+# -------------------------
+# The SDK upload needs the whole file as bytes. Posting to the Storage REST
+# endpoint with a chunk generator keeps only UPLOAD_CHUNK_SIZE in memory.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+_storage_http: Optional[httpx.AsyncClient] = None
+
+def get_storage_http() -> httpx.AsyncClient:
+    global _storage_http
+    if _storage_http is None:
+        _storage_http = httpx.AsyncClient(timeout=60.0)
+    return _storage_http
+
+@router.on_event("shutdown")
+async def close_storage_http():
+    if _storage_http is not None:
+        await _storage_http.aclose()
+
+@router.on_event("shutdown")
+def stop_log_listener():
+    # Flushes records still in the queue, then joins the listener thread
+    _log_listener.stop()
+
+async def stream_upload(file: UploadFile, filename: str, content_type: str) -> int:
+    size = 0
+
+    async def chunks():
+        nonlocal size
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            yield chunk
+
+    res = await get_storage_http().post(
+        f"{SUPABASE_URL}/storage/v1/object/{BUCKET}/{filename}",
+        content=chunks(),
+        headers={
+            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+            "apikey": SUPABASE_SERVICE_KEY,
+            "Content-Type": content_type,
+            "x-upsert": "true"
+        }
+    )
+    res.raise_for_status()
+    return size
+
+async def object_exists(filename: str) -> bool:
+    res = await get_storage_http().head(
+        f"{SUPABASE_URL}/storage/v1/object/authenticated/{BUCKET}/{filename}",
+        headers={
+            "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+            "apikey": SUPABASE_SERVICE_KEY
+        }
+    )
+    if res.status_code in (400, 404):
+        return False
+    res.raise_for_status()
+    return True
 
 # -------------------------
 # Upload endpoint
@@ -52,41 +137,97 @@ async def upload_profile_image(
     file: UploadFile = Form(...)
 ):
     try:
-        debug("Received upload request", {"userId": userId, "filename": file.filename})
-        ensure_bucket_exists()
+        log.debug("Received upload request userId=%s filename=%s", userId, file.filename)
+        if not _bucket_checked:
+            await asyncio.to_thread(ensure_bucket_exists)
 
-        content = await file.read()
-        debug("File size bytes", len(content))
-
-        # Get file extension
-        ext = os.path.splitext(file.filename)[1] or ".png"
-        filename = f"profile_{userId}{ext}"
-        debug("Uploading as filename", filename)
+        filename = profile_object_name(userId, file.filename)
+        log.debug("Uploading as filename %s", filename)
 
         # Guess content type
         content_type, _ = mimetypes.guess_type(file.filename)
         if content_type is None:
             content_type = "application/octet-stream"
-        debug("Detected content type", content_type)
+        log.debug("Detected content type %s", content_type)
+
+        public_url = public_object_url(filename)
+        log.debug("Public URL %s", public_url)
 
-        # Upload to Supabase (use upsert="true" as string)
-        supabase.storage.from_(BUCKET).upload(
-            filename,
-            content,
-            {"upsert": "true"}  # <- must be string
+        # Stream to Supabase Storage (overwrites any previous picture). The
+        # users row is only pointed at the URL once the upload has succeeded.
+        size = await stream_upload(file, filename, content_type)
+        log.debug("File size bytes %d", size)
+        log.debug("Upload successful %s", filename)
+
+        res = await asyncio.to_thread(
+            lambda: supabase.table("users").update({"profilePicUrl": public_url}).eq("id", userId).execute()
         )
-        debug("Upload successful", filename)
+        log.debug("DB update result %s", res)
 
-        # Get public URL
-        public_url = supabase.storage.from_(BUCKET).get_public_url(filename)
-        debug("Public URL", public_url)
+        return {"url": public_url}
 
-        # Update user table
-        res = supabase.table("users").update({"profilePicUrl": public_url}).eq("id", userId).execute()
-        debug("DB update result", res)
+    except Exception as e:
+        log.error("Upload failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
 
+# -------------------------
+# Direct-to-storage upload
+# -------------------------
+# The client asks for a signed upload URL, PUTs the image straight to
+# Storage, then calls /commit. The image bytes never pass through this process.
+@router.post("/uploadProfileImage/signed")
+async def create_profile_upload_url(
+    userId: str = Form(...),
+    filename: str = Form(...)
+):
+    try:
+        if not _bucket_checked:
+            await asyncio.to_thread(ensure_bucket_exists)
+
+        object_name = profile_object_name(userId, filename)
+        res = await get_storage_http().post(
+            f"{SUPABASE_URL}/storage/v1/object/upload/sign/{BUCKET}/{object_name}",
+            headers={
+                "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+                "apikey": SUPABASE_SERVICE_KEY,
+                "x-upsert": "true"
+            }
+        )
+        res.raise_for_status()
+        signed_path = res.json()["url"]  # /object/upload/sign/...?token=...
+        log.debug("Signed upload URL for %s", object_name)
+
+        return {
+            "signed_url": f"{SUPABASE_URL.rstrip('/')}/storage/v1{signed_path}",
+            "path": object_name,
+            "url": public_object_url(object_name)
+        }
+
+    except Exception as e:
+        log.error("Signed URL failed: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/uploadProfileImage/commit")
+async def commit_profile_upload(
+    userId: str = Form(...),
+    filename: str = Form(...)
+):
+    try:
+        object_name = profile_object_name(userId, filename)
+
+        # Only save the URL if the client's PUT actually landed
+        if not await object_exists(object_name):
+            raise HTTPException(status_code=404, detail="Uploaded image not found")
+
+        public_url = public_object_url(object_name)
+        res = await asyncio.to_thread(
+            lambda: supabase.table("users").update({"profilePicUrl": public_url}).eq("id", userId).execute()
+        )
+        log.debug("DB update result %s", res)
         return {"url": public_url}
 
+    except HTTPException:
+        raise
     except Exception as e:
-        debug("Upload failed", str(e))
+        log.error("Commit failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,14 +1,17 @@
 import os
-import json
 import re
+import orjson
 import asyncio
 from datetime import datetime, timezone
 from typing import Dict, Any, List, Optional
 
+import numpy as np
 from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel
-from openai import OpenAI
-from supabase import create_client
+from db import get_async_supabase, get_pg_pool
+from psych_map import trait_values
+from llm import aclient, post_chat_text, post_embedding, extract_json_object
 
 # -------------------------
 # ENV
@@ -20,10 +23,7 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 if not all([OPENAI_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
     raise RuntimeError("Missing OPENAI_API_KEY or SUPABASE_URL or SUPABASE_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 router = APIRouter()
 
 # -------------------------
@@ -43,18 +43,19 @@ def now_iso() -> str:
 def safe_load_json_fragment(text: str) -> Dict:
     if not text or not isinstance(text, str):
         return {}
+    # Well-formed replies parse in one go; the brace scan is the fallback
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
     try:
-        start = text.find("{")
-        end = text.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            return json.loads(text[start:end+1])
+        fragment = extract_json_object(text)
+        if fragment:
+            return orjson.loads(fragment)
     except Exception:
         pass
     return {}
 
-async def to_thread(fn, *args):
-    return await asyncio.to_thread(fn, *args)
-
 # -------------------------
 # SANA CHAT PROMPT
 # -------------------------
@@ -66,56 +67,57 @@ Avoid repeating the same sentence structure.
 No astrology. No therapy jargon.
 """
 
-
-def _call_chat(payload):
-    return client.chat.completions.create(**payload)
+# Built once: every reply starts with the same system message, which keeps the
+# prefix byte-identical for OpenAI prompt caching
+_REPLY_MESSAGES_HEAD = [{"role": "system", "content": SANA_REPLY_SYSTEM}]
 
 async def call_sana_reply(prompt: str) -> str:
     payload = {
         "model": "gpt-5-nano",
-        "messages": [
-            {"role": "system", "content": SANA_REPLY_SYSTEM},
-            {"role": "user", "content": prompt}
-        ]
+        "messages": _REPLY_MESSAGES_HEAD + [{"role": "user", "content": prompt}]
     }
-    resp = await to_thread(_call_chat, payload)
-    return resp.choices[0].message.content.strip()
+    return (await post_chat_text(payload)).strip()
+
+async def stream_sana_reply(prompt: str):
+    stream = await aclient.chat.completions.create(
+        model="gpt-5-nano",
+        messages=_REPLY_MESSAGES_HEAD + [{"role": "user", "content": prompt}],
+        stream=True
+    )
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
 
 # -------------------------
 # GPT MATCH REASONER
 # -------------------------
-def gpt_rank_and_explain_sync(user_profile: Dict, request_text: str, candidates: List[Dict]) -> str:
+RANK_SYSTEM = "Return STRICT JSON: { \"matches\": [{\"id\":..., \"score\":..., \"reason\": \"...\"}] }"
+_RANK_MESSAGES_HEAD = [{"role": "system", "content": RANK_SYSTEM}]
+
+async def gpt_rank_and_explain(user_profile: Dict, request_text: str, candidates: List[Dict]) -> str:
     summary = [{"id": c.get("id"), "name": c.get("name")} for c in candidates[:12]]
 
-    system = "Return STRICT JSON: { \"matches\": [{\"id\":..., \"score\":..., \"reason\": \"...\"}] }"
     user_prompt = {
         "request_text": request_text,
-        "user_profile": user_profile,
+        "user_profile": trait_values(user_profile),
         "candidates": summary
     }
 
-    resp = client.chat.completions.create(
-        model="gpt-5-nano",
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": json.dumps(user_prompt)}
-        ],
-    )
-    return resp.choices[0].message.content
+    return await post_chat_text({
+        "model": "gpt-5-nano",
+        "messages": _RANK_MESSAGES_HEAD + [{"role": "user", "content": orjson.dumps(user_prompt, option=orjson.OPT_NON_STR_KEYS).decode()}],
+    })
 
 # -------------------------
 # EMBEDDINGS
 # -------------------------
 EMBED_MODEL = "text-embedding-3-small"
 
-def embed_sync(text: str) -> List[float]:
-    return client.embeddings.create(
-        model=EMBED_MODEL,
-        input=text
-    ).data[0].embedding
-
 async def embed_text_async(text: str) -> List[float]:
-    return await asyncio.to_thread(embed_sync, text)
+    return await post_embedding(text, EMBED_MODEL)
 
 # -------------------------
 # MATCHING HELPERS
@@ -128,20 +130,144 @@ def normalize_gender(g: Optional[str]) -> str:
     if g.startswith("f"): return "female"
     return ""
 
-def try_rpc_match(query_vector: List[float], k: int = 50):
+def target_gender_for(user_gender: Optional[str]) -> Optional[str]:
+    g = normalize_gender(user_gender)
+    if g in ["male", "female"]:
+        return "female" if g == "male" else "male"
+    return None
+
+async def try_rpc_match(query_vector: List[float], exclude_user_id: str,
+                        target_gender: Optional[str], k: int = 50):
+    # Filters run in Postgres (sql/match_chat_candidates.sql)
     try:
-        res = supabase.rpc("match_users", {
+        db = await get_async_supabase()
+        res = await db.rpc("match_chat_candidates", {
             "query_vector": query_vector,
-            "match_limit": k
+            "match_limit": k,
+            "exclude_id": exclude_user_id,
+            "target_gender_prefix": target_gender[0] if target_gender else None
         }).execute()
         return res.data or []
     except Exception as e:
         print("RPC match failed:", e)
+        return None
+
+def parse_vector(v) -> Optional[List[float]]:
+    # pgvector columns come back from PostgREST as "[0.1,0.2,...]" strings
+    if isinstance(v, str):
+        try:
+            v = orjson.loads(v)
+        except orjson.JSONDecodeError:
+            return None
+    return v if isinstance(v, list) and v else None
+
+def unit_vector(v: List[float]) -> np.ndarray:
+    q = np.asarray(v, dtype=np.float32)
+    return q / (np.linalg.norm(q) + 1e-12)
+
+def vector_matrix(rows: List[Dict], dim: int, column: str = "psych_vector"):
+    # Parse every vector string ("[...]" pgvector or "{...}" array text) in one
+    # np.fromstring pass (C speed) instead of orjson -> Python floats -> array
+    # per row. Rows of another dimension are dropped up front by counting
+    # separators. Returns the positions of the kept rows and their (N, D) matrix.
+    keep, texts = [], []
+    for i, r in enumerate(rows):
+        v = r.get(column)
+        if isinstance(v, list):
+            v = ",".join(map(str, v))
+        elif isinstance(v, str):
+            v = v.strip("[]{} ")
+        else:
+            continue
+        if v and v.count(",") == dim - 1:
+            keep.append(i)
+            texts.append(v)
+    if not keep:
+        return keep, None
+
+    try:
+        C = np.fromstring(",".join(texts), dtype=np.float32, sep=",")
+    except ValueError:
+        C = None
+    if C is None or C.size != len(keep) * dim:
+        # Something non-numeric slipped in; parse row by row and skip the bad ones
+        parsed = [(i, parse_vector(f"[{t}]")) for i, t in zip(keep, texts)]
+        parsed = [(i, vec) for i, vec in parsed if vec and len(vec) == dim]
+        keep = [i for i, _ in parsed]
+        if not keep:
+            return keep, None
+        C = np.asarray([vec for _, vec in parsed], dtype=np.float32)
+    return keep, C.reshape(len(keep), dim)
+
+def rank_by_cosine(rows: List[Dict], query_vector: List[float], k: int,
+                   quantized: bool = False) -> List[Dict]:
+    # One (N, D) @ (D,) product instead of a Python loop per candidate. Stored
+    # psych_vectors are unit-length (sql/match_users_filtered.sql), so with a
+    # unit query the dot product is the cosine similarity. Quantized rows are
+    # int8 codes times a per-row scale (sql/users_psych_vector_q.sql); the codes
+    # go through the same float32 BLAS product and the scale is applied after.
+    # Scores stay in one array indexed like `keep`; only the top k rows are
+    # turned back into result dicts.
+    keep, C = vector_matrix(rows, len(query_vector), "psych_vector_q" if quantized else "psych_vector")
+    if not keep:
+        return []
+    sims = C @ unit_vector(query_vector)
+    if quantized:
+        sims *= np.fromiter((rows[i].get("psych_vector_scale") or 0.0 for i in keep),
+                            dtype=np.float32, count=len(keep))
+
+    k = min(k, len(keep))
+    top = np.argpartition(-sims, k - 1)[:k]
+    top = top[np.argsort(-sims[top])]
+    return [
+        {"id": rows[keep[j]]["id"], "name": rows[keep[j]].get("name"),
+         "gender": rows[keep[j]].get("gender"), "similarity": float(sims[j])}
+        for j in top
+    ]
+
+LOCAL_MATCH_SCAN_LIMIT = 5000
+
+async def local_vector_match(query_vector: List[float], exclude_user_id: str,
+                             target_gender: Optional[str], k: int = 50) -> List[Dict]:
+    # Fallback when the RPC is unavailable: score the eligible users here, with
+    # the same filters pushed into the select
+    db = await get_async_supabase()
+
+    async def scan(columns: str, vector_column: str):
+        query = db.table("users").select(
+            f"id, name, gender, {columns}"
+        ).neq("id", exclude_user_id).not_.is_(vector_column, "null")
+        if target_gender:
+            query = query.ilike("gender", f"{target_gender[0]}%")
+        return (await query.limit(LOCAL_MATCH_SCAN_LIMIT).execute()).data
+
+    # int8 codes are a third of the float text to download and parse
+    try:
+        rows = await scan("psych_vector_q::text, psych_vector_scale", "psych_vector_q")
+        quantized = True
+    except Exception as e:
+        print("Quantized vectors unavailable, scanning psych_vector:", e)
+        rows = await scan("psych_vector", "psych_vector")
+        quantized = False
+
+    if not rows:
         return []
+    # Parsing and scoring are both CPU work, so both stay off the event loop
+    return await asyncio.to_thread(rank_by_cosine, rows, query_vector, k, quantized)
 
-async def vector_search_candidates(query_vector: List[float], exclude_user_id: str, k: int = 50):
-    rows = try_rpc_match(query_vector, k)
-    return [r for r in rows if r.get("id") != exclude_user_id]
+async def vector_search_candidates(query_vector: List[float], exclude_user_id: str,
+                                   target_gender: Optional[str] = None, k: int = 50):
+    query_vector = unit_vector(query_vector).tolist()
+    rows = await try_rpc_match(query_vector, exclude_user_id, target_gender, k)
+    if rows is None:
+        rows = await local_vector_match(query_vector, exclude_user_id, target_gender, k)
+    return rows
+
+# -------------------------
+# CHAT CONTEXT
+# -------------------------
+# Turns of context sent with each reply; also the size of users.recent_chat
+RECENT_CHAT_SIZE = 6
 
 # -------------------------
 # MATCH INTENT
@@ -151,32 +277,129 @@ MATCH_KEYWORDS = [
     "soulmate", "date", "dating", "true love", "loyal", "someone who"
 ]
 
+# One compiled alternation scans the message once, no lower() copy. Keywords
+# must start at a word boundary so "update" or "candidate" don't read as "date".
+_MATCH_KEYWORDS_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, MATCH_KEYWORDS)) + ")", re.IGNORECASE
+)
+
 def looks_like_match_request(text: str) -> bool:
-    t = text.lower()
-    return any(kw in t for kw in MATCH_KEYWORDS)
+    return _MATCH_KEYWORDS_RE.search(text) is not None
+
+# -------------------------
+# CHAT TURN HELPERS
+# -------------------------
+FALLBACK_REPLY = "I’m here with you."
+
+def build_reply_prompt(user: Dict, user_message: str, user_name: str) -> str:
+    # recent_chat holds the last RECENT_CHAT_SIZE turns (sql/users_recent_chat.sql)
+    recent = user.get("recent_chat") or []
+    context = "\n".join([m.get("content", "") for m in recent])
+    return f"Context:\n{context}\nUser: {user_message}\nName: {user_name}"
+
+async def fetch_user_columns(db, user_id: str, columns: str) -> Dict:
+    # `columns` is always a literal from this module, never request input
+    pool = await get_pg_pool()
+    if pool is not None:
+        row = await pool.fetchrow(f"select {columns} from users where id = $1", user_id)
+        if row is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return dict(row)
+    return (await db.table("users").select(columns).eq("id", user_id).single().execute()).data
+
+# Flipped off if PostgREST reports append_sana_chat_turn missing (migration not run yet)
+_append_rpc_available = True
+
+async def save_chat_turn(db, user_id: str, user_name: str, user_message: str, sana_reply: str, now: str):
+    turn = [
+        {"role": "user", "name": user_name, "content": user_message, "time": now},
+        {"role": "sana", "name": "sana", "content": sana_reply, "time": now}
+    ]
+    memory = {"content": user_message, "time": now}
+
+    # Send only the new turn; Postgres inserts the messages into
+    # sana_chat_messages and caps recent_chat/memories (sql/sana_chat_messages.sql)
+    pool = await get_pg_pool()
+    if pool is not None:
+        await pool.execute(
+            "select append_sana_chat_turn($1, $2, $3, 200, 400, $4)",
+            user_id, turn, memory, RECENT_CHAT_SIZE
+        )
+        return
+
+    global _append_rpc_available
+    if _append_rpc_available:
+        try:
+            await db.rpc("append_sana_chat_turn", {
+                "p_user_id": user_id,
+                "p_messages": turn,
+                "p_memory": memory,
+                "p_history_cap": 200,
+                "p_memory_cap": 400,
+                "p_recent_cap": RECENT_CHAT_SIZE
+            }).execute()
+            return
+        except Exception as e:
+            # Only a missing function means the old layout. Anything else
+            # (timeout, 5xx) may even have committed, and nothing reads
+            # users.chat_history once the migrations ran, so don't write there.
+            if getattr(e, "code", None) != "PGRST202":
+                print("append_sana_chat_turn RPC failed:", e)
+                raise
+            print("append_sana_chat_turn not deployed, rewriting users.chat_history")
+            # Stop paying for the failed call every turn
+            _append_rpc_available = False
+
+    # No RPC means none of the migrations ran, so history is still the
+    # users.chat_history array
+    full = (await db.table("users").select("chat_history, memories").eq(
+        "id", user_id
+    ).single().execute()).data
+    chat_history = full.get("chat_history") or []
+    memories = full.get("memories") or []
+
+    # Both lists are fresh from the db, so trim them in place
+    chat_history.extend(turn)
+    del chat_history[:-200]
+    memories.append(memory)
+    del memories[:-400]
+    await db.table("users").update({
+        "chat_history": chat_history,
+        "recent_chat": chat_history[-RECENT_CHAT_SIZE:],
+        "memories": memories
+    }).eq("id", user_id).execute()
 
 # =========================================================
 # ✅ ✅ ✅ FINAL /sana/chat ENDPOINT (ONE PIECE)
 # =========================================================
 @router.post("/sana/chat")
 async def sana_chat(data: SanaChatMessage):
+    if not all([data.id, data.name, data.message]):
+        raise HTTPException(status_code=400, detail="Missing id, name, or message")
+
+    return await answer_sana_chat(data, looks_like_match_request(data.message))
+
+async def answer_sana_chat(data: SanaChatMessage, is_match_request: bool):
+    # Shared by both routes; the intent regex has already run on the message
     user_id = data.id
     user_name = data.name
     user_message = data.message
 
-    if not all([user_id, user_name, user_message]):
-        raise HTTPException(status_code=400, detail="Missing id, name, or message")
+    # The request embedding only needs the message, so it runs while the user row loads
+    embed_task = asyncio.create_task(embed_text_async(user_message)) if is_match_request else None
 
-    user = supabase.table("users").select(
-        "chat_history, psych_map, profile_candidates, gender, memories"
-    ).eq("id", user_id).single().execute().data
+    # Each branch only downloads the columns it reads
+    columns = "psych_map, gender" if is_match_request else "recent_chat"
 
-    chat_history = user.get("chat_history") or []
-    memories = user.get("memories") or []
-    psych_map = user.get("psych_map") or {}
+    db = await get_async_supabase()
+    try:
+        user = await fetch_user_columns(db, user_id, columns)
+    except Exception:
+        if embed_task:
+            embed_task.cancel()
+        raise
 
     now = now_iso()
-    is_match_request = looks_like_match_request(user_message)
 
     # ==================================================
     # ❤️ MATCH MODE — PLACEHOLDER + VECTOR + GPT
@@ -186,33 +409,22 @@ async def sana_chat(data: SanaChatMessage):
             sana_reply = "Sana found these for you."
 
             # VECTOR SEARCH
-            request_vector = await embed_text_async(user_message)
+            request_vector = await embed_task
             candidates = await vector_search_candidates(
                 request_vector,
                 exclude_user_id=user_id,
+                target_gender=target_gender_for(user.get("gender")),
                 k=50
             )
 
-            # GENDER FILTER
-            user_gender = normalize_gender(user.get("gender"))
-            if user_gender in ["male", "female"]:
-                target_gender = "female" if user_gender == "male" else "male"
-                candidates = [
-                    c for c in candidates
-                    if normalize_gender(c.get("gender")) == target_gender
-                ]
-
             top_for_refine = candidates[:15]
 
             # GPT REASONING
-            def _gpt_refine():
-                return gpt_rank_and_explain_sync(
-                    psych_map,
-                    user_message,
-                    top_for_refine
-                )
-
-            gpt_resp_text = await asyncio.to_thread(_gpt_refine)
+            gpt_resp_text = await gpt_rank_and_explain(
+                user.get("psych_map") or {},
+                user_message,
+                top_for_refine
+            )
             matches_struct = safe_load_json_fragment(gpt_resp_text)
 
             if isinstance(matches_struct, dict):
@@ -232,16 +444,13 @@ async def sana_chat(data: SanaChatMessage):
                     for c in top_for_refine[:5]
                 ]
 
-            # SAVE MATCH HISTORY
-            profile_candidates = (user.get("profile_candidates") or [])[-200:]
-            profile_candidates.append({
-                "match_results": match_results,
+            # SAVE MATCH HISTORY (append-only, sql/sana_history_tables.sql)
+            await db.table("profile_candidates").insert({
+                "user_id": user_id,
+                "kind": "match",
+                "candidate": {"match_results": match_results},
                 "time": now
-            })
-
-            supabase.table("users").update({
-                "profile_candidates": profile_candidates
-            }).eq("id", user_id).execute()
+            }).execute()
 
             return {
                 "reply": sana_reply,
@@ -259,34 +468,72 @@ async def sana_chat(data: SanaChatMessage):
     # 💬 NORMAL CHAT MODE
     # ==================================================
     else:
-        recent = chat_history[-6:]
-        context = "\n".join([m.get("content", "") for m in recent])
-
-        reply_prompt = f"Context:\n{context}\nUser: {user_message}\nName: {user_name}"
+        reply_prompt = build_reply_prompt(user, user_message, user_name)
 
         try:
             sana_reply = await call_sana_reply(reply_prompt)
         except Exception as e:
             print("Chat error:", e)
-            sana_reply = "I’m here with you."
+            sana_reply = FALLBACK_REPLY
 
-        chat_history += [
-            {"role": "user", "name": user_name, "content": user_message, "time": now},
-            {"role": "sana", "name": "sana", "content": sana_reply, "time": now}
-        ]
-
-        memories.append({"content": user_message, "time": now})
-
-        supabase.table("users").update({
-            "chat_history": chat_history[-200:],
-            "memories": memories[-400:]
-        }).eq("id", user_id).execute()
+        await save_chat_turn(db, user_id, user_name, user_message, sana_reply, now)
 
         return {
             "reply": sana_reply,
             "match_results": None
         }
 
+# -------------------------
+# /sana/chat/stream (SSE)
+# -------------------------
+# Same contract as /sana/chat, but chat replies arrive as `data: {"delta": ...}`
+# events while the model generates them, followed by one `event: done` carrying
+# the usual {"reply", "match_results"} body. Match requests skip straight to done.
+def sse_event(payload: Dict, event: Optional[str] = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {orjson.dumps(payload).decode()}\n\n"
+
+@router.post("/sana/chat/stream")
+async def sana_chat_stream(data: SanaChatMessage):
+    if not all([data.id, data.name, data.message]):
+        raise HTTPException(status_code=400, detail="Missing id, name, or message")
+
+    if looks_like_match_request(data.message):
+        result = await answer_sana_chat(data, True)
+
+        async def match_events():
+            yield sse_event(result, "done")
+
+        return StreamingResponse(match_events(), media_type="text/event-stream")
+
+    db = await get_async_supabase()
+    user = await fetch_user_columns(db, data.id, "recent_chat")
+    reply_prompt = build_reply_prompt(user, data.message, data.name)
+    now = now_iso()
+
+    async def chat_events():
+        parts = []
+        try:
+            async for delta in stream_sana_reply(reply_prompt):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+        except Exception as e:
+            print("Chat stream error:", e)
+
+        sana_reply = "".join(parts).strip()
+        if not sana_reply:
+            sana_reply = FALLBACK_REPLY
+            yield sse_event({"delta": sana_reply})
+
+        await save_chat_turn(db, data.id, data.name, data.message, sana_reply, now)
+        yield sse_event({"reply": sana_reply, "match_results": None}, "done")
+
+    return StreamingResponse(
+        chat_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # -------------------------
 # ATTACH ROUTER
 # -------------------------
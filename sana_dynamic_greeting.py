@@ -1,18 +1,14 @@
-import os, json, asyncio
+import os
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from openai import OpenAI
-from supabase import create_client
+from llm import aclient
+from db import supabase_service as supabase
 from dotenv import load_dotenv
 
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 router = APIRouter()
 
 
@@ -41,8 +37,7 @@ def fetch_user_profile(user_id: str):
 # -------- OpenAI Async Wrapper --------
 async def call_openai_async(prompt: str, system_msg: str):
     try:
-        resp = await asyncio.to_thread(
-            client.responses.create,
+        resp = await aclient.responses.create(
             model="gpt-5-nano",
             input=[
                 {
@@ -61,6 +56,19 @@ async def call_openai_async(prompt: str, system_msg: str):
 
 
 
+# Same text on every call (cacheable prefix); the profile goes in the user message
+GREETING_SYSTEM = """You are Sana, a deeply human AI psychologist.
+Give one psychological reflection based on the user's profile.
+
+Rules:
+• One line max...Pick one key insight from their data
+• Simple, human language, their name or a nickname based on their name 
+• Make them feel safe, prepared, and understood
+• No poetry, no metaphors
+Formart : Insight heading(for example Qualties about you, weakness etc)  • reflection
+"""
+
+
 # -------- Main Greeting Route --------
 @router.post("/sana/greeting")
 async def sana_dynamic_greeting(data: SanaGreetingRequest):
@@ -73,21 +81,13 @@ async def sana_dynamic_greeting(data: SanaGreetingRequest):
     name = profile.get("name", "there").split()[0]
 
     prompt = f"""
-Give one psychological reflection based on:
 name: {name}
 Moods: {profile.get("moods")}
 Personality traits: {profile.get("personality_traits")}
 Love language: {profile.get("love_language")}
 Interests: {profile.get("interests")}
 Relationship goals: {profile.get("relationship_goals")}
-
-Rules:
-• One line max...Pick one key insight from the data above
-• Simple, human language, their name or a nickname based on their name 
-• Make them feel safe, prepared, and understood
-• No poetry, no metaphors
-Formart : Insight heading(for example Qualties about you, weakness etc)  • reflection
 """
 
-    greeting = await call_openai_async(prompt, "You are Sana, a deeply human AI psychologist.")
+    greeting = await call_openai_async(prompt, GREETING_SYSTEM)
     return {"greeting": greeting}
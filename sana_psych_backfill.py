@@ -8,6 +8,9 @@ from typing import Dict, Any, List
 
 import openai
 from supabase import create_client
+from postgrest.exceptions import APIError
+
+from psych_map import trait_values
 
 # ----------------------------------------------------
 # CONFIG
@@ -75,6 +78,28 @@ def normalize_chat_history(raw):
     return "\n".join(lines)
 
 
+def fetch_user_messages(user_id: str):
+    """User-side Sana chat messages, oldest first (sql/sana_chat_messages.sql)."""
+    try:
+        resp = (
+            supabase.table("sana_chat_messages")
+            .select("role, content")
+            .eq("user_id", user_id)
+            .eq("role", "user")
+            .order("time")
+            .order("id")
+            .execute()
+        )
+        return resp.data or []
+    except APIError as e:
+        # Only a missing table (not migrated yet) falls back to the old array
+        if e.code not in ("42P01", "PGRST205"):
+            raise
+        log.warning(f"sana_chat_messages not migrated, using chat_history: {e}")
+        resp = supabase.table("users").select("chat_history").eq("id", user_id).execute()
+        return (resp.data[0].get("chat_history") if resp.data else None) or []
+
+
 # ----------------------------------------------------
 # OPENAI WRAPPERS (with retry & JSON safety)
 # ----------------------------------------------------
@@ -104,7 +129,11 @@ async def safe_llm_call(payload, label="LLM"):
             await asyncio.sleep(0.5 * (attempt + 1))
 
     log.error(f"{label} FAILED ALL ATTEMPTS — using fallback")
-    return {"extracted_traits": []} if label == "EXTRACT" else {k: [] for k in REL_KEYS}
+    if label == "EXTRACT":
+        return {"extracted_traits": []}
+    if label == "EXTRACT+ROUTE":
+        return {"extracted_traits": [], "relationship_profile": {k: [] for k in REL_KEYS}}
+    return {k: [] for k in REL_KEYS}
 
 
 # ----------------------------------------------------
@@ -161,6 +190,38 @@ Rules:
     return await safe_llm_call(payload, label="ROUTE")
 
 
+# ----------------------------------------------------
+# EXTRACT + ROUTE IN ONE CALL (users with no psych map yet)
+# ----------------------------------------------------
+async def extract_and_route(chats: str):
+    base_schema = {k: [] for k in REL_KEYS}
+
+    payload = {
+        "model": "gpt-5-nano",
+        "messages": [
+            {
+                "role": "system",
+                "content": f"""
+Extract psychological traits about the USER only, and map them into the
+relationship schema below.
+Return STRICT JSON:
+{{
+ "extracted_traits":[{{"key":"...","value":"...","confidence":0.0}}],
+ "relationship_profile": {json.dumps(base_schema)}
+}}
+
+Rules for relationship_profile:
+- No guessing
+- 1–3 word values only
+"""
+            },
+            {"role": "user", "content": chats}
+        ],
+    }
+
+    return await safe_llm_call(payload, label="EXTRACT+ROUTE")
+
+
 # ----------------------------------------------------
 # EMBEDDING FUNCTION
 # ----------------------------------------------------
@@ -191,27 +252,35 @@ def merge_traits(existing: dict, traits: List[Dict]):
 # ----------------------------------------------------
 async def process_user(user):
     user_id = user["id"]
-    raw_chat = user.get("chat_history") or ""
-    chats = normalize_chat_history(raw_chat)
-
     psych_map = user.get("psych_map") or {}
 
+    # Chat is only needed to build an empty psych map
+    chats = ""
+    if is_empty_psych_map(psych_map):
+        chats = normalize_chat_history(await asyncio.to_thread(fetch_user_messages, user_id))
+
     # Skip completely empty users
     if is_empty_psych_map(psych_map) and not chats:
         log.info(f"SKIPPED (no psych + no chat): {user_id}")
         return
 
-    # Build psych map from chat if empty
+    # Build psych map from chat if empty; the same call also routes it, saving
+    # a second prefill + round trip
     if is_empty_psych_map(psych_map):
         log.info(f"Extracting traits from chat: {user_id}")
-        extracted = await extract_traits(chats)
-        psych_map = merge_traits({}, extracted.get("extracted_traits", []))
-
-    # Build relationship profile
-    relationship_profile = await route_relationship(psych_map)
-
-    # Vector embeddings
-    vector = await asyncio.to_thread(embed_sync, json.dumps(psych_map))
+        combined = await extract_and_route(chats)
+        psych_map = merge_traits({}, combined.get("extracted_traits", []))
+        relationship_profile = combined.get("relationship_profile")
+        if not isinstance(relationship_profile, dict):
+            relationship_profile = await route_relationship(trait_values(psych_map))
+    else:
+        relationship_profile = await route_relationship(trait_values(psych_map))
+
+    # Vector embeddings of the traits only (no history), the same text
+    # sana_psych_worker embeds; stored unit-length (matching ranks by inner product)
+    vector = await asyncio.to_thread(embed_sync, json.dumps(trait_values(psych_map)))
+    norm = sum(x * x for x in vector) ** 0.5 or 1.0
+    vector = [x / norm for x in vector]
 
     # Save to DB
     supabase.table("users").update({
@@ -229,7 +298,7 @@ async def process_user(user):
 async def run_backfill():
     log.info("🚀 Starting 20× parallel backfill...")
 
-    resp = supabase.table("users").select("id, psych_map, chat_history").execute()
+    resp = supabase.table("users").select("id, psych_map").execute()
     users = resp.data or []
 
     tasks = [process_user(u) for u in users]
@@ -0,0 +1,85 @@
+# sana_psych_queue_worker.py
+# Consumes /sana/psych/update jobs queued in Redis (PSYCH_QUEUE_URL) and runs
+# the extractor / merge / embedding pipeline outside the API process.
+#
+#   PSYCH_QUEUE_URL=redis://... python sana_psych_queue_worker.py
+#
+# Jobs are moved (BLMOVE, Redis >= 6.2) onto PSYCH_PROCESSING_KEY while they
+# run and removed once done, so a crash leaves them there instead of losing
+# them. On startup anything left over is pushed back onto the queue. Delivery
+# is at-least-once: with several workers, restarting one also re-queues the
+# jobs the others have in flight.
+
+from dotenv import load_dotenv
+load_dotenv()
+import asyncio
+import logging
+
+import orjson
+
+from sana_psych_worker import psych_queue, process_psych_update, PSYCH_QUEUE_KEY
+
+# ----------------------------------------------------
+# CONFIG
+# ----------------------------------------------------
+MAX_WORKERS = 20   # concurrent jobs; concurrent extractor calls share a batch
+POP_TIMEOUT = 5    # seconds per BLMOVE, so shutdown is noticed
+PSYCH_PROCESSING_KEY = f"{PSYCH_QUEUE_KEY}:processing"
+
+log = logging.getLogger("sana-psych-queue")
+
+semaphore = asyncio.Semaphore(MAX_WORKERS)
+running = set()  # strong refs so in-flight jobs are not garbage collected
+
+async def run_job(raw: bytes):
+    try:
+        job = orjson.loads(raw)
+        await process_psych_update(job["id"], job["message"])
+    except Exception as e:
+        log.error(f"❌ PSYCH JOB FAILED: {e} | {raw[:200]!r}")
+    finally:
+        # Failed jobs are dropped too (logged above) so one bad payload
+        # cannot loop forever
+        try:
+            await psych_queue.lrem(PSYCH_PROCESSING_KEY, 1, raw)
+        except Exception as e:
+            log.error(f"❌ Could not ack psych job: {e}")
+        semaphore.release()
+
+async def requeue_unfinished():
+    # Jobs a previous run took but never finished
+    requeued = 0
+    while await psych_queue.lmove(PSYCH_PROCESSING_KEY, PSYCH_QUEUE_KEY, "LEFT", "RIGHT") is not None:
+        requeued += 1
+    if requeued:
+        log.info(f"♻️ Re-queued {requeued} unfinished psych jobs")
+
+# ----------------------------------------------------
+# MAIN LOOP
+# ----------------------------------------------------
+async def run_worker():
+    if psych_queue is None:
+        raise RuntimeError("PSYCH_QUEUE_URL is not set")
+
+    await requeue_unfinished()
+    log.info(f"🚀 Psych queue worker listening on {PSYCH_QUEUE_KEY}")
+    while True:
+        await semaphore.acquire()
+        # The API LPUSHes, so the oldest job is on the right
+        raw = await psych_queue.blmove(PSYCH_QUEUE_KEY, PSYCH_PROCESSING_KEY, POP_TIMEOUT, "RIGHT", "LEFT")
+        if raw is None:
+            semaphore.release()
+            continue
+        task = asyncio.create_task(run_job(raw))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+# ----------------------------------------------------
+# ENTRY POINT
+# ----------------------------------------------------
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s | %(levelname)s | %(message)s",
+    )
+    asyncio.run(run_worker())
@@ -9,15 +9,23 @@
 import os
 import json
 import re
+import orjson
+import numpy as np
 import asyncio
 import logging
+import weakref
 from datetime import datetime, timezone
 from typing import Dict, Any, List, Optional
 
 from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from openai import OpenAI
-from supabase import create_client
+from db import get_async_supabase
+from llm import async_retry, post_chat_text, post_embedding, extract_json_object
+from cachetools import TTLCache
+from batching import drain_batch
+from psych_map import trait_values
+import redis.asyncio as aioredis
 
 # -------------------------
 # LOGGING SETUP
@@ -38,10 +46,7 @@ SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 if not all([OPENAI_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
     raise RuntimeError("Missing ENV vars")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 router = APIRouter()
 
 # -------------------------
@@ -58,27 +63,26 @@ class PsychUpdateRequest(BaseModel):
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
+_WHITESPACE_RE = re.compile(r"\s+")
+
 def safe_load_json_fragment(text: str) -> Dict:
     if not text or not isinstance(text, str):
         return {}
     try:
-        m = re.search(r"\{.*\}", text, re.DOTALL)
-        if m:
-            return json.loads(m.group(0))
+        fragment = extract_json_object(text)
+        if fragment:
+            return orjson.loads(fragment)
     except Exception:
         pass
     return {}
 
-async def to_thread_retry(fn, *args, retries=3, backoff=0.4, **kwargs):
-    last_exc = None
-    for i in range(retries):
-        try:
-            return await asyncio.to_thread(fn, *args, **kwargs)
-        except Exception as e:
-            last_exc = e
-            log.warning(f"Thread retry {i+1} failed: {e}")
-            await asyncio.sleep(backoff * (2 ** i))
-    raise last_exc
+def load_json_response(text: str) -> Dict:
+    # JSON-mode replies parse directly; the brace scan is only a fallback
+    try:
+        parsed = orjson.loads(text)
+        return parsed if isinstance(parsed, dict) else {}
+    except (TypeError, orjson.JSONDecodeError):
+        return safe_load_json_fragment(text)
 
 RELATIONSHIP_KEYS = [
     "moods", "personality_traits", "love_language", "relationship_goals", "interests",
@@ -97,46 +101,161 @@ DYNAMIC_EXTRACTOR_SYSTEM = """
 You are a psychological inference engine for building meaningful connections.
 Extract psychological traits about the USER only.
 
-Return STRICT JSON only:
-{
-  "extracted_traits": [
-    {"key":"...", "value":"...", "confidence": 0.0}
-  ]
-}
+Return STRICT JSON only, one [key, value, confidence] triple per trait, [] if none:
+{"t": [["key", "value", 0.0]]}
 """
 
 # -------------------------
 # LLM
 # -------------------------
-def _call_chat(payload: Dict[str, Any]):
-    return client.chat.completions.create(**payload)
+def expand_traits(raw: Any) -> Dict[str, Any]:
+    # The model answers with compact [key, value, confidence] triples; the rest
+    # of the pipeline (merge, profile_candidates) keeps the keyed dict shape.
+    if isinstance(raw, dict):
+        raw = raw.get("t", raw.get("extracted_traits"))
+    traits = []
+    for it in raw if isinstance(raw, list) else []:
+        if isinstance(it, dict):
+            traits.append(it)
+        elif isinstance(it, list) and len(it) >= 2:
+            traits.append({
+                "key": it[0],
+                "value": it[1],
+                "confidence": it[2] if len(it) > 2 else 0.0
+            })
+    return {"extracted_traits": traits}
+
+# Constant system heads keep every request's prefix identical (prompt caching)
+_EXTRACTOR_MESSAGES_HEAD = [{"role": "system", "content": DYNAMIC_EXTRACTOR_SYSTEM}]
+
+async def extract_single(user_message: str) -> Dict[str, Any]:
+    payload = {
+        "model": "gpt-5-nano",
+        "response_format": {"type": "json_object"},
+        "messages": _EXTRACTOR_MESSAGES_HEAD + [{"role": "user", "content": user_message}],
+    }
 
-async def call_dynamic_extractor(user_message: str) -> Dict[str, Any]:
+    text = await async_retry(post_chat_text, payload)
+    log.info(f"RAW DYNAMIC OUTPUT: {text}")
+
+    return expand_traits(load_json_response(text))
+
+# -------------------------
+# EXTRACTOR MICRO-BATCHING
+# -------------------------
+# Messages arriving within EXTRACTOR_BATCH_WINDOW share one completion, so the
+# system prompt is paid once per batch instead of once per user.
+EXTRACTOR_BATCH_SIZE = 8
+EXTRACTOR_BATCH_WINDOW = 0.03  # seconds
+
+DYNAMIC_EXTRACTOR_BATCH_SYSTEM = DYNAMIC_EXTRACTOR_SYSTEM + """
+You will receive a JSON list of N independent user messages.
+Extract traits for each message separately and return STRICT JSON only:
+{"results": [[["key", "value", 0.0]], []]}
+"results" must have exactly N trait lists, in the same order as the messages.
+"""
+
+_EXTRACTOR_BATCH_MESSAGES_HEAD = [{"role": "system", "content": DYNAMIC_EXTRACTOR_BATCH_SYSTEM}]
+
+# Batches run concurrently, up to EXTRACTOR_MAX_IN_FLIGHT completions at once;
+# while every slot is busy the next batch keeps filling up in the queue
+EXTRACTOR_MAX_IN_FLIGHT = 16
+EXTRACT_QUEUE_SIZE = 1000
+
+_extract_queue: asyncio.Queue = asyncio.Queue(maxsize=EXTRACT_QUEUE_SIZE)
+_extract_slots = asyncio.Semaphore(EXTRACTOR_MAX_IN_FLIGHT)
+_extract_batches = set()
+_extract_worker_task = None
+
+async def extract_batch(messages: List[str]) -> List[Dict[str, Any]]:
     payload = {
         "model": "gpt-5-nano",
-        "messages": [
-            {"role": "system", "content": DYNAMIC_EXTRACTOR_SYSTEM},
-            {"role": "user", "content": user_message}
+        "response_format": {"type": "json_object"},
+        "messages": _EXTRACTOR_BATCH_MESSAGES_HEAD + [
+            {"role": "user", "content": orjson.dumps(messages).decode()}
         ],
     }
 
-    resp = await to_thread_retry(_call_chat, payload)
-    text = resp.choices[0].message.content
-    log.info(f"RAW DYNAMIC OUTPUT: {text}")
+    text = await async_retry(post_chat_text, payload)
+    log.info(f"RAW DYNAMIC BATCH OUTPUT ({len(messages)}): {text}")
+
+    results = load_json_response(text).get("results")
+    if not isinstance(results, list) or len(results) != len(messages):
+        # Misaligned output can't be attributed to users; redo them one by one
+        log.warning(f"Batch extractor returned a bad shape for {len(messages)} messages")
+        return await asyncio.gather(*(extract_single(m) for m in messages))
 
-    parsed = safe_load_json_fragment(text)
-    return parsed if isinstance(parsed, dict) else {"extracted_traits": []}
+    return [expand_traits(r) for r in results]
+
+async def run_extract_batch(batch: list):
+    messages = [m for m, _ in batch]
+    try:
+        if len(batch) == 1:
+            results = [await extract_single(messages[0])]
+        else:
+            results = await extract_batch(messages)
+    except Exception as e:
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    for (_, fut), res in zip(batch, results):
+        if not fut.done():
+            fut.set_result(res)
+
+async def extract_worker():
+    while True:
+        await _extract_slots.acquire()
+        try:
+            batch = await drain_batch(_extract_queue, EXTRACTOR_BATCH_SIZE, EXTRACTOR_BATCH_WINDOW)
+        except BaseException:
+            _extract_slots.release()
+            raise
+        task = asyncio.create_task(run_extract_batch(batch))
+        _extract_batches.add(task)
+        task.add_done_callback(_extract_batches.discard)
+        task.add_done_callback(lambda _: _extract_slots.release())
+
+async def extract_via_batch(user_message: str) -> Dict[str, Any]:
+    global _extract_worker_task
+    if _extract_worker_task is None or _extract_worker_task.done():
+        _extract_worker_task = asyncio.create_task(extract_worker())
+    fut = asyncio.get_running_loop().create_future()
+    await _extract_queue.put((user_message, fut))
+    return await fut
 
 # -------------------------
-# AUTO RELATIONSHIP BUILDER ✅
+# EXTRACTOR CACHE
 # -------------------------
-async def auto_route_psych_to_relationship(psych_map: Dict[str, Any]) -> Dict[str, List[str]]:
-    base = {k: [] for k in RELATIONSHIP_KEYS}
+# Extraction depends only on the message text, so exact repeats ("ok",
+# "good morning", retries of the same message) reuse an earlier result.
+# Only normalized text is matched: paraphrases can differ in exactly the
+# specifics that become traits ("I'm 25" / "I'm 52").
+_exact_extract_cache = TTLCache(maxsize=10_000, ttl=24 * 3600)
+
+def _unit(vec: List[float]) -> np.ndarray:
+    q = np.asarray(vec, dtype=np.float32)
+    return q / (np.linalg.norm(q) + 1e-12)
+
+async def call_dynamic_extractor(user_message: str) -> Dict[str, Any]:
+    text_key = " ".join(user_message.lower().split())
+    cached = _exact_extract_cache.get(text_key)
+    if cached is not None:
+        log.info("♻️ EXTRACTOR CACHE HIT")
+        return cached
 
-    system = f"""
+    result = await extract_via_batch(user_message)
+    _exact_extract_cache[text_key] = result
+    return result
+
+# -------------------------
+# AUTO RELATIONSHIP BUILDER ✅
+# -------------------------
+# The schema never changes, so the prompt is rendered once at import
+RELATIONSHIP_ROUTER_SYSTEM = f"""
 Map the psychological traits into this JSON schema:
 
-{json.dumps(base, indent=2)}
+{json.dumps({k: [] for k in RELATIONSHIP_KEYS}, indent=2)}
 
 Rules:
 - No guessing
@@ -145,46 +264,90 @@ Rules:
 - STRICT JSON only
 """
 
+_ROUTER_MESSAGES_HEAD = [{"role": "system", "content": RELATIONSHIP_ROUTER_SYSTEM}]
+
+def router_input(psych_map: Dict[str, Any]) -> str:
+    # The router maps values, so each trait's observation history (up to
+    # PSYCH_HISTORY_SIZE timestamped entries) is left out of the prompt
+    return orjson.dumps(trait_values(psych_map)).decode()
+
+def dedupe_list_field(values) -> list:
+    # Order-preserving, one pass: a seen-set instead of `x not in out` scans.
+    # Strings compare case/space-insensitively; dicts/lists by their JSON.
+    seen, out = set(), []
+    for v in values if isinstance(values, list) else [values]:
+        if isinstance(v, str):
+            key = " ".join(v.lower().split())
+            if not key:
+                continue
+        elif isinstance(v, (dict, list)):
+            key = orjson.dumps(v, option=orjson.OPT_SORT_KEYS)
+        else:
+            key = v
+        if key not in seen:
+            seen.add(key)
+            out.append(v)
+    return out
+
+async def auto_route_psych_to_relationship(psych_map: Dict[str, Any]) -> Dict[str, List[str]]:
     payload = {
         "model": "gpt-5-nano",
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user", "content": json.dumps(psych_map)}
-        ],
+        "response_format": {"type": "json_object"},
+        "messages": _ROUTER_MESSAGES_HEAD + [{"role": "user", "content": router_input(psych_map)}],
     }
 
-    resp = await to_thread_retry(_call_chat, payload)
-    text = resp.choices[0].message.content
-    parsed = safe_load_json_fragment(text)
+    text = await async_retry(post_chat_text, payload)
+    parsed = load_json_response(text)
 
     if isinstance(parsed, dict):
+        parsed = {k: dedupe_list_field(v) if v is not None else [] for k, v in parsed.items()}
         log.info(f"✅ AUTO RELATIONSHIP PROFILE: {parsed}")
         return parsed
 
-    return base
+    return {k: [] for k in RELATIONSHIP_KEYS}
 
 # -------------------------
 # MERGE PSYCH
 # -------------------------
-def merge_into_psych_map(existing: Dict[str, Any], extracted: Dict[str, Any]) -> Dict[str, Any]:
-    out = json.loads(json.dumps(existing or {}))
-    now = now_iso()
+def trait_signature(psych_map: Dict[str, Any]) -> frozenset:
+    # What the router and the embedding care about: each trait's value and
+    # confidence, ignoring history timestamps
+    return frozenset(
+        (k, orjson.dumps(e.get("value"), option=orjson.OPT_SORT_KEYS), e.get("confidence"))
+        if isinstance(e, dict) else (k, orjson.dumps(e, option=orjson.OPT_SORT_KEYS), None)
+        for k, e in psych_map.items()
+    )
+
+PSYCH_HISTORY_SIZE = 8  # observations kept per trait, inside the entry
+
+def merge_into_psych_map(existing: Dict[str, Any], extracted: Dict[str, Any], now: str) -> Dict[str, Any]:
+    # `existing` is kept as the "before" snapshot in profile_versions. Touched
+    # keys get brand-new entry dicts below, so a shallow copy keeps it intact.
+    out = dict(existing or {})
 
     items = extracted.get("extracted_traits", [])
     log.info(f"TRAITS TO MERGE: {items}")
 
     for it in items:
-        key = (it.get("key") or "").strip().lower().replace(" ", "_")
+        key = _WHITESPACE_RE.sub("_", (it.get("key") or "").strip().lower())
         val = it.get("value")
         conf = float(it.get("confidence", 0.0))
 
         if not key or not val:
             continue
 
+        # Copy the touched history (the old entry belongs to the "before"
+        # snapshot) and keep only the last PSYCH_HISTORY_SIZE observations
+        prev = existing.get(key) if existing else None
+        history = list(prev.get("history") or []) if isinstance(prev, dict) else []
+        if len(history) >= PSYCH_HISTORY_SIZE:
+            del history[:len(history) - PSYCH_HISTORY_SIZE + 1]
+        history.append({"time": now, "value": val, "confidence": conf})
+
         out[key] = {
             "value": val,
             "confidence": conf,
-            "history": [{"time": now, "value": val, "confidence": conf}]
+            "history": history
         }
 
     log.info(f"UPDATED PSYCH MAP: {out}")
@@ -195,14 +358,18 @@ def merge_into_psych_map(existing: Dict[str, Any], extracted: Dict[str, Any]) ->
 # -------------------------
 EMBED_MODEL = "text-embedding-3-small"
 
-def embed_sync(text: str) -> List[float]:
-    resp = client.embeddings.create(model=EMBED_MODEL, input=text)
-    return resp.data[0].embedding
+async def embed_text(text: str) -> List[float]:
+    return await async_retry(post_embedding, text, EMBED_MODEL)
 
 async def embed_and_store_user_vector(user_id: str, psych_map: Dict[str, Any]):
-    vector = await asyncio.to_thread(embed_sync, json.dumps(psych_map))
-
-    res = supabase.table("users").update({
+    # Embed the traits only: history timestamps would just add noise to the
+    # vector. Stdlib json.dumps of {value, confidence} is the same text the
+    # backfill embeds, so both kinds of stored vectors stay comparable.
+    # Stored unit-length so match_users_filtered can rank by inner product (<#>)
+    vector = _unit(await embed_text(json.dumps(trait_values(psych_map)))).tolist()
+
+    db = await get_async_supabase()
+    res = await db.table("users").update({
         "psych_vector": vector
     }).eq("id", user_id).execute()
 
@@ -210,52 +377,154 @@ async def embed_and_store_user_vector(user_id: str, psych_map: Dict[str, Any]):
     log.info(f"SUPABASE VECTOR UPDATE RESPONSE: {res}")
 
 # -------------------------
-# MAIN ENDPOINT ✅✅✅
+# PSYCH UPDATE
 # -------------------------
-@router.post("/sana/psych/update")
-async def update_psych(data: PsychUpdateRequest):
-    user_id = data.id
-    user_message = data.message
-
+# Acks, greetings and messages without a single letter (emoji, digits,
+# punctuation) carry no traits; for those the extractor, router and embedding
+# would all reproduce the current maps, so the update is skipped. Length alone
+# is no signal: "I'm vegan" and "hate cats" are short but worth extracting.
+TRIVIAL_MESSAGES = frozenset({
+    "ok", "okay", "k", "kk", "hi", "hii", "hey", "hello", "yo", "yes", "yeah",
+    "yep", "ya", "no", "nope", "nah", "lol", "lmao", "haha", "hahaha", "hmm",
+    "hm", "thanks", "thank you", "thx", "ty", "cool", "nice", "sure", "fine",
+    "good", "great", "wow", "oh", "ah", "bye", "gn", "gm", "good morning",
+    "good night", "good evening", "how are you", "what", "why", "really",
+})
+
+_extract_stats = {"seen": 0, "skipped": 0}
+
+def _worth_extracting(msg: str) -> bool:
+    words = "".join(c if c.isalpha() or c.isspace() else " " for c in msg.lower()).split()
+    return bool(words) and " ".join(words) not in TRIVIAL_MESSAGES
+
+# Held only while an update for that user is in flight, then collected
+_user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _lock_for(user_id: str) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def process_psych_update(user_id: str, user_message: str) -> Optional[str]:
+    # Returns the update time, or None when the message was skipped
     log.info(f"🚀 PSYCH UPDATE STARTED: {user_id}")
     log.info(f"USER MESSAGE: {user_message}")
 
-    resp = supabase.table("users").select(
-        "id, psych_map, relationship_profile, profile_candidates, profile_versions"
-    ).eq("id", user_id).single().execute()
+    _extract_stats["seen"] += 1
+    if not _worth_extracting(user_message):
+        _extract_stats["skipped"] += 1
+        log.info(
+            f"⏭️ PSYCH UPDATE SKIPPED (low-signal message): {user_id} | "
+            f"skipped {_extract_stats['skipped']}/{_extract_stats['seen']}"
+        )
+        return None
+
+    # The extractor only needs the message, so it runs while the user row loads
+    extractor_task = asyncio.create_task(call_dynamic_extractor(user_message))
+
+    db = await get_async_supabase()
+    # Serialize read-merge-write per user so concurrent messages don't clobber
+    # each other's traits (within this process)
+    async with _lock_for(user_id):
+        return await _merge_and_store(db, user_id, extractor_task)
+
+async def _merge_and_store(db, user_id: str, extractor_task: asyncio.Task) -> str:
+    try:
+        resp = await db.table("users").select("psych_map").eq("id", user_id).single().execute()
+    except Exception:
+        extractor_task.cancel()
+        raise
 
     user = resp.data
     psych_map = user.get("psych_map") or {}
-    profile_candidates = user.get("profile_candidates") or []
-    profile_versions = user.get("profile_versions") or []
-
-    dynamic_res = await call_dynamic_extractor(user_message)
-    updated_psych_map = merge_into_psych_map(psych_map, dynamic_res)
-
-    relationship_profile = await auto_route_psych_to_relationship(updated_psych_map)
 
     now = now_iso()
-    profile_candidates.append({"candidate": dynamic_res, "time": now})
-    profile_versions.append({
-        "before": psych_map,
-        "after": updated_psych_map,
-        "candidate": dynamic_res,
-        "time": now
-    })
-
-    res = supabase.table("users").update({
-        "psych_map": updated_psych_map,
-        "relationship_profile": relationship_profile,
-        "profile_candidates": profile_candidates[-200:],
-        "profile_versions": profile_versions[-500:]
-    }).eq("id", user_id).execute()
+    dynamic_res = await extractor_task
+    updated_psych_map = merge_into_psych_map(psych_map, dynamic_res, now)
+
+    # Same traits with the same values/confidences (only history grew): the
+    # relationship profile and psych_vector would come out the same, so keep them
+    traits_changed = trait_signature(updated_psych_map) != trait_signature(psych_map)
+
+    user_update = {"psych_map": updated_psych_map}
+    if traits_changed:
+        user_update["relationship_profile"] = await auto_route_psych_to_relationship(updated_psych_map)
+    else:
+        log.info(f"⏭️ TRAITS UNCHANGED, keeping relationship profile and vector: {user_id}")
+
+    # Only the current maps live on the users row; candidates and versions are
+    # appended as rows (sql/sana_history_tables.sql). All of it runs together.
+    writes = [
+        db.table("users").update(user_update).eq("id", user_id).execute(),
+        db.table("profile_candidates").insert({
+            "user_id": user_id,
+            "kind": "psych",
+            "candidate": dynamic_res,
+            "time": now
+        }).execute(),
+        db.table("profile_versions").insert({
+            "user_id": user_id,
+            "before": psych_map,
+            "after": updated_psych_map,
+            "candidate": dynamic_res,
+            "time": now
+        }).execute()
+    ]
+    if traits_changed:
+        writes.append(embed_and_store_user_vector(user_id, updated_psych_map))
+    res, *_ = await asyncio.gather(*writes)
 
     log.info(f"✅ SUPABASE PSYCH UPDATE RESPONSE: {res}")
+    return now
+
+# -------------------------
+# QUEUE (optional)
+# -------------------------
+# With PSYCH_QUEUE_URL (a Redis URL) set, the endpoint only enqueues the job and
+# sana_psych_queue_worker.py runs the LLM work in its own process, so API
+# workers never spend event-loop time on extraction.
+PSYCH_QUEUE_URL = os.getenv("PSYCH_QUEUE_URL")
+PSYCH_QUEUE_KEY = "sana:psych"
+
+psych_queue = aioredis.from_url(PSYCH_QUEUE_URL) if PSYCH_QUEUE_URL else None
 
-    await embed_and_store_user_vector(user_id, updated_psych_map)
+async def last_psych_update_time(user_id: str) -> Optional[str]:
+    db = await get_async_supabase()
+    res = await db.table("profile_versions").select("time") \
+        .eq("user_id", user_id).order("time", desc=True).limit(1).execute()
+    return res.data[0]["time"] if res.data else None
+
+# -------------------------
+# MAIN ENDPOINT ✅✅✅
+# -------------------------
+@router.post("/sana/psych/update")
+async def update_psych(data: PsychUpdateRequest):
+    if psych_queue is not None:
+        queued_at = now_iso()
+        await psych_queue.lpush(PSYCH_QUEUE_KEY, orjson.dumps({
+            "id": data.id,
+            "message": data.message,
+            "time": queued_at
+        }))
+        log.info(f"📥 PSYCH UPDATE QUEUED: {data.id}")
+        return {
+            "status": "queued",
+            "user_id": data.id,
+            "queued_at": queued_at
+        }
+
+    now = await process_psych_update(data.id, data.message)
+    if now is None:
+        # Nothing was written; report when the map last actually changed
+        return {
+            "status": "skipped",
+            "user_id": data.id,
+            "updated_at": await last_psych_update_time(data.id)
+        }
 
     return {
         "status": "ok",
-        "user_id": user_id,
+        "user_id": data.id,
         "updated_at": now
     }
@@ -61,8 +61,8 @@ semaphore = asyncio.Semaphore(MAX_CONCURRENT_WORKERS)
 def call_llm(payload: Dict[str, Any]):
     return openai.ChatCompletion.create(**payload)
 
-async def auto_route_psych_to_relationship(psych_map: Dict[str, Any]) -> Dict[str, List[str]]:
-    system = f"""
+# Rendered once; identical for every user
+RELATIONSHIP_SYSTEM = f"""
 Map the psychological traits into this JSON schema:
 
 {json.dumps(BASE_PROFILE, indent=2)}
@@ -74,10 +74,11 @@ Rules:
 - STRICT JSON only
 """
 
+async def auto_route_psych_to_relationship(psych_map: Dict[str, Any]) -> Dict[str, List[str]]:
     payload = {
         "model": "gpt-5-nano",
         "messages": [
-            {"role": "system", "content": system},
+            {"role": "system", "content": RELATIONSHIP_SYSTEM},
             {"role": "user", "content": json.dumps(psych_map)}
         ],
     }
@@ -1,16 +1,12 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from supabase import create_client
+from db import supabase
+from postgrest.exceptions import APIError
+from realtime_chat import invalidate_user_cache
 from datetime import datetime, date
-import os, json
 
 router = APIRouter()
 
-# 🔑 environment setup
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 
 # 🧠 model for user data
 class UserData(BaseModel):
@@ -34,6 +30,48 @@ def calculate_age_from_birthdate(birthdate: str) -> int | None:
         return None
 
 
+def save_user_rows(user: UserData, user_data: dict):
+    # Fallback when the RPC is missing: check, assign the Cosmic ID, then write
+    # 🟣 Check if user exists
+    existing = supabase.table("users").select("sana_id").eq("id", user.id).execute()
+    exists = bool(existing.data)
+    existing_user = existing.data[0] if exists else None
+
+    # 🌟 Assign Cosmic ID (only if new user or missing cosmic_id)
+    if not exists or not existing_user.get("sana_id"):
+        try:
+            counter = (
+                supabase.table("settings")
+                .select("value")
+                .eq("key", "max_sana_id")
+                .single()
+                .execute()
+            )
+            max_id = int(counter.data["value"]) if counter.data else 0
+            next_number = max_id + 1
+            cosmic_id = f"S{next_number}"
+
+            # update the counter in DB
+            supabase.table("settings").update({"value": next_number}).eq("key", "max_sana_id").execute()
+            user_data["sana_id"] = cosmic_id
+            print(f"🌌 Assigned Cosmic ID {cosmic_id} to {user.name or user.id}")
+        except Exception as e:
+            print(f"⚠️ Cosmic ID assignment failed: {e}")
+
+    # 🔄 Create or Update user
+    if exists:
+        result = supabase.table("users").update(user_data).eq("id", user.id).execute()
+        print(f"🌀 Updated user {user.id}")
+        status = "updated"
+    else:
+        result = supabase.table("users").insert(user_data).execute()
+        print(f"🌟 Created new user {user.id}")
+        status = "created"
+
+    # The write already returns the fresh row; no need to read it back
+    return status, (result.data[0] if result.data else None)
+
+
 @router.post("/save_user")
 async def save_user(user: UserData):
     """
@@ -41,50 +79,24 @@ async def save_user(user: UserData):
     Also auto-calculates age and assigns cosmic_id if missing.
     """
     try:
-        # 🟣 Check if user exists
-        existing = supabase.table("users").select("*").eq("id", user.id).execute()
-        exists = bool(existing.data)
-        existing_user = existing.data[0] if exists else None
-
         user_data = {k: v for k, v in user.model_dump().items() if v is not None}
 
-        # 🧮 Calculate and include age if birthdate is present
-
-        # 🌟 Assign Cosmic ID (only if new user or missing cosmic_id)
-        if not exists or not existing_user.get("sana_id"):
-            try:
-                counter = (
-                    supabase.table("settings")
-                    .select("value")
-                    .eq("key", "max_sana_id")
-                    .single()
-                    .execute()
-                )
-                max_id = int(counter.data["value"]) if counter.data else 0
-                next_number = max_id + 1
-                cosmic_id = f"S{next_number}"
-
-                # update the counter in DB
-                supabase.table("settings").update({"value": next_number}).eq("key", "max_sana_id").execute()
-                user_data["sana_id"] = cosmic_id
-                print(f"🌌 Assigned Cosmic ID {cosmic_id} to {user.name or user.id}")
-            except Exception as e:
-                print(f"⚠️ Cosmic ID assignment failed: {e}")
-
-        # 🔄 Create or Update user
-        if exists:
-            result = supabase.table("users").update(user_data).eq("id", user.id).execute()
-            print(f"🌀 Updated user {user.id}")
-            status = "updated"
-        else:
-            result = supabase.table("users").insert(user_data).execute()
-            print(f"🌟 Created new user {user.id}")
-            status = "created"
-
-        # Return the fresh user record
-        updated_user = (
-            supabase.table("users").select("*").eq("id", user.id).single().execute().data
-        )
+        # One round trip: upsert + Cosmic ID in Postgres (sql/save_user_profile.sql)
+        try:
+            res = supabase.rpc("save_user_profile", {"p_id": user.id, "p_data": user_data}).execute()
+            status, updated_user = res.data["status"], res.data["data"]
+            print(f"{'🌟 Created new' if status == 'created' else '🌀 Updated'} user {user.id}")
+        except APIError as e:
+            # Only a missing function falls back: after a timeout or constraint
+            # error the RPC may have committed, and rewriting field by field
+            # would save twice and burn a second Cosmic ID
+            if e.code != "PGRST202":
+                raise
+            print("save_user_profile not deployed, saving field by field")
+            status, updated_user = save_user_rows(user, user_data)
+
+        # Push notifications cache names and device tokens; drop the stale ones
+        invalidate_user_cache(user.id)
 
         return {"status": status, "data": updated_user}
 
@@ -1,10 +1,14 @@
 import os
 import json
+import base64
 from datetime import datetime, timezone
+from typing import Optional
 from fastapi import APIRouter, HTTPException
-from supabase import create_client
-from openai import OpenAI
-import random
+from pydantic import BaseModel, ValidationError
+from cachetools import TTLCache
+from db import supabase
+from llm import aclient
+import heapq
 import traceback
 import asyncio
 
@@ -13,14 +17,13 @@ router = APIRouter()
 # -------------------------
 # Setup
 # -------------------------
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 # Default to gpt-5-nano when OPENAI_MODEL not provided in environment
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-5-nano")
-
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Candidates below this psych-vector cosine similarity are never chart-scored.
+# Psych-map embeddings share most of their structure, so pairs below ~0.3 are
+# effectively unrelated; set to -1 to disable the cut.
+MIN_PSYCH_SIMILARITY = float(os.environ.get("MIN_PSYCH_SIMILARITY", "0.3"))
 
 # -------------------------
 # Astrology constants
@@ -86,43 +89,78 @@ def decrypt_if_needed(val):
 # -------------------------
 # Compatibility Engine
 # -------------------------
-def deep_compatibility(user_chart, crush_chart):
-    user_chart = safe_json(user_chart)
-    crush_chart = safe_json(crush_chart)
+def chart_features(chart):
+    """Reduce a chart to the fixed-order values deep_compatibility needs.
+
+    Returns ([(longitude, house_multiplier) or None per PLANET_WEIGHTS planet], ascendant element).
+    """
+    chart = safe_json(chart)
+    planets = chart.get("planets", {})
+
+    positions = []
+    for planet in PLANET_WEIGHTS:
+        p = planets.get(planet)
+        if not p or p.get("longitude") is None:
+            positions.append(None)
+        else:
+            positions.append((p["longitude"], HOUSE_IMPORTANCE.get(p.get("house"), 1.0)))
+
+    asc_sign = chart.get("ascendant", {}).get("sign")
+    # Tuples keep the features hashable, so they can key the score cache
+    return tuple(positions), SIGN_ELEMENTS.get(asc_sign) if asc_sign else None
 
-    u_planets = user_chart.get("planets", {})
-    c_planets = crush_chart.get("planets", {})
+def compatibility_from_features(user_features, crush_features):
+    u_positions, ue = user_features
+    c_positions, ce = crush_features
 
     total_score = 0
     total_weight = 0
 
-    for planet, weight in PLANET_WEIGHTS.items():
-        u = u_planets.get(planet)
-        c = c_planets.get(planet)
-        if not u or not c:
+    for weight, u, c in zip(PLANET_WEIGHTS.values(), u_positions, c_positions):
+        if u is None or c is None:
             continue
 
-        diff = angle_diff(u["longitude"], c["longitude"])
-        aspect_score = get_aspect_score(diff)
-        house_multiplier = HOUSE_IMPORTANCE.get(u.get("house"), 1.0)
+        u_lon, house_multiplier = u
+        aspect_score = get_aspect_score(angle_diff(u_lon, c[0]))
 
         total_score += aspect_score * weight * house_multiplier
         total_weight += weight * house_multiplier
 
-    u_sign = user_chart.get("ascendant", {}).get("sign")
-    c_sign = crush_chart.get("ascendant", {}).get("sign")
-
-    if u_sign and c_sign:
-        ue = SIGN_ELEMENTS.get(u_sign)
-        ce = SIGN_ELEMENTS.get(c_sign)
-        if ue and ce and ue == ce:
-            total_score += ELEMENT_SCORE[ue]
+    if ue and ce and ue == ce:
+        total_score += ELEMENT_SCORE[ue]
 
     if total_weight == 0:
         return 0
 
     return max(0, min(100, round((total_score / (total_weight * 10)) * 100)))
 
+def deep_compatibility(user_chart, crush_chart):
+    return compatibility_from_features(chart_features(user_chart), chart_features(crush_chart))
+
+# Chart compatibility only changes when a birth chart does, so pair scores are
+# reused for a day instead of being recomputed on every match request. The key
+# is both charts' features (not the user ids), so a regenerated chart gets a
+# fresh score immediately.
+SCORE_CACHE_TTL = 24 * 60 * 60
+_score_cache = TTLCache(maxsize=200_000, ttl=SCORE_CACHE_TTL)
+
+# Parsed chart + reduced features per user. Entries carry the raw chart they
+# came from and only hit when the row still holds the same chart, so a
+# regenerated chart is picked up without any invalidation hook.
+CHART_CACHE_TTL = 60 * 60
+_chart_cache = TTLCache(maxsize=100_000, ttl=CHART_CACHE_TTL)
+
+def cached_chart(uid: Optional[str], chart_raw):
+    """Return (parsed chart, chart_features) for a user's raw chart column."""
+    hit = _chart_cache.get(uid) if uid else None
+    if hit is not None and hit[0] == chart_raw:
+        return hit[1], hit[2]
+    parsed = safe_json(chart_raw)
+    features = chart_features(parsed)
+    if uid:
+        _chart_cache[uid] = (chart_raw, parsed, features)
+    return parsed, features
+
 def classify_connection(score):
     if score >= 85: return "soulmate"
     if score >= 30: return "twin_flame"
@@ -131,31 +169,91 @@ def classify_connection(score):
 # -------------------------
 # Supabase helpers
 # -------------------------
-def fetch_user(uid: str):
-    res = supabase.table("users").select("*").eq("id", uid).execute()
+# Only the columns the matching response actually reads
+CANDIDATE_COLUMNS = (
+    "id, sana_id, name, profilePicUrl, gender, chart, age, "
+    "birthdate, birthplace, last_active, relationship_profile"
+)
+
+def fetch_user(uid: str, columns: str = "*"):
+    res = supabase.table("users").select(columns).eq("id", uid).execute()
     return res.data[0] if res.data else None
 
-def fetch_top_psych_matches(vector: list, limit: int = 100):
+def candidate_query(exclude_user_id: str, exclude_gender: str):
+    # Self, same-gender and under-18 rows are filtered by Postgres, not in Python.
+    # neq alone would also drop NULL gender, which the Python filter kept.
+    return (
+        supabase.table("users")
+        .select(CANDIDATE_COLUMNS)
+        .neq("id", exclude_user_id)
+        .or_(f'gender.neq."{exclude_gender}",gender.is.null')
+        .gte("age", 18)
+    )
+
+def fetch_top_psych_matches(vector: list, limit: int = 100, exclude_id: str = None, exclude_gender: str = None,
+                            min_similarity: float = MIN_PSYCH_SIMILARITY):
+    # ANN search with the candidate filters applied in Postgres (sql/match_users_filtered.sql)
+    if exclude_id and exclude_gender:
+        try:
+            res = supabase.rpc("match_users_filtered", {
+                "query_vector": vector,
+                "match_limit": limit,
+                "exclude_id": exclude_id,
+                "exclude_gender": exclude_gender,
+                "min_similarity": min_similarity
+            }).execute()
+            return res.data or []
+        except Exception as e:
+            print("🔥 [vector search] filtered RPC failed, trying match_users:", e)
+
     try:
         res = supabase.rpc("match_users", {
             "query_vector": vector,
             "match_limit": limit
         }).execute()
-        return res.data or []
+        # match_users has no threshold parameter; apply it here instead
+        return [m for m in (res.data or []) if m.get("similarity", 1) >= min_similarity]
     except Exception as e:
         print("🔥 [vector search] failed:", e)
-        # Fallback to general fetch if RPC fails
-        res = supabase.table("users").select("*").limit(limit).execute()
+        # Fallback to general fetch if RPC fails (only ids are used downstream)
+        res = supabase.table("users").select("id").limit(limit).execute()
         return res.data or []
 
+# -------------------------
+# Pagination cursor
+# -------------------------
+MAX_MATCHES_PAGE = 100
+
+class MatchCursor(BaseModel):
+    last_active: float
+    id: str
+
+def encode_match_cursor(match: dict) -> str:
+    raw = json.dumps({"last_active": match["last_active"], "id": match["id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_match_cursor(cursor: str) -> MatchCursor:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return MatchCursor.model_validate_json(raw)
+    except (ValueError, ValidationError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def match_sort_key(match: dict):
+    # Most recently active first, id as a stable tie-breaker
+    return (-match["last_active"], match["id"] or "")
+
 # -------------------------
 # API Routes
 # -------------------------
 
 @router.get("/soul_of_anlasana_2_1/{user_id}")
-async def soul_of_anlasana(user_id: str):
+async def soul_of_anlasana(user_id: str, limit: int = 30, cursor: Optional[str] = None):
+    limit = max(1, min(limit, MAX_MATCHES_PAGE))
+    after = decode_match_cursor(cursor) if cursor else None
+
     try:
-        user = fetch_user(user_id)
+        user = fetch_user(user_id, "id, gender, chart, psych_vector")
         if not user:
             print(f"❌ [Matching] User {user_id} not found in database")
             return {"user_id": user_id, "matches": []}
@@ -170,10 +268,13 @@ async def soul_of_anlasana(user_id: str):
             print(f"❌ [Matching] User missing required fields - chart: {bool(target_chart)}, gender: {bool(target_gender)}")
             return {"user_id": user_id, "matches": []}
 
+        # Decode and reduce the target chart once instead of once per candidate
+        _, target_features = cached_chart(user_id, target_chart)
+
         # Quality matching: Start with top 100 psychological matches
         if target_vector:
             # RPC returns only IDs, we need to fetch full user data
-            match_results = fetch_top_psych_matches(target_vector, 100)
+            match_results = fetch_top_psych_matches(target_vector, 100, user_id, target_gender)
             print(f"📊 [Matching] RPC returned {len(match_results)} results")
             if match_results and len(match_results) > 0:
                 print(f"🔍 [Matching] First RPC result keys: {list(match_results[0].keys())}")
@@ -187,8 +288,11 @@ async def soul_of_anlasana(user_id: str):
                 
                 if user_ids:
                     print(f"🔍 [Matching] Re-fetching full data for {len(user_ids)} users...")
-                    res = supabase.table("users").select("*").in_("id", user_ids).execute()
-                    candidates = res.data or []
+                    res = candidate_query(user_id, target_gender).in_("id", user_ids).execute()
+                    # in_() comes back in table order; index by id once and walk the
+                    # RPC's similarity order so name de-dup keeps the closest match
+                    by_id = {c["id"]: c for c in (res.data or [])}
+                    candidates = [by_id[uid] for uid in user_ids if uid in by_id]
                     print(f"✅ [Matching] Successfully fetched {len(candidates)} full user records")
                     if candidates and len(candidates) > 0:
                         print(f"🔍 [Matching] First candidate keys: {list(candidates[0].keys())}")
@@ -202,16 +306,13 @@ async def soul_of_anlasana(user_id: str):
                 candidates = []
         else:
             print(f"⚠️ [Matching] No psych_vector, using general query")
-            res = supabase.table("users").select("*").limit(100).execute()
+            res = candidate_query(user_id, target_gender).limit(100).execute()
             candidates = res.data or []
             print(f"📊 [Matching] Found {len(candidates)} candidates via general query")
 
         matches, seen = [], set()
         skipped_reasons = {
-            "same_user": 0,
-            "same_gender": 0,
             "no_chart": 0,
-            "under_18": 0,
             "duplicate_name": 0,
             "no_relationship_profile": 0
         }
@@ -223,13 +324,6 @@ async def soul_of_anlasana(user_id: str):
             print(f"🔎 [Debug] Candidate {i+1}: id={cid}..., has_chart_field={chart_data is not None}, chart_type={type(chart_data)}, chart_value_preview={str(chart_data)[:100] if chart_data else 'None'}")
         
         for other in candidates:
-            if other.get("id") == user_id: 
-                skipped_reasons["same_user"] += 1
-                continue
-            if other.get("gender") == target_gender: 
-                skipped_reasons["same_gender"] += 1
-                continue
-            
             chart_raw = other.get("chart")
             if not chart_raw:
                 skipped_reasons["no_chart"] += 1
@@ -237,7 +331,7 @@ async def soul_of_anlasana(user_id: str):
             
             # Try to parse the chart to see if it's valid
             try:
-                chart_parsed = safe_json(chart_raw)
+                chart_parsed, other_features = cached_chart(other.get("id"), chart_raw)
                 if not chart_parsed or not chart_parsed.get("planets"):
                     oid = (other.get("id") or "")[:10]
                     print(f"⚠️ [Debug] Chart exists but is empty/invalid for user {oid}... - chart_parsed: {chart_parsed}")
@@ -249,16 +343,17 @@ async def soul_of_anlasana(user_id: str):
                 skipped_reasons["no_chart"] += 1
                 continue
             
-            if (other.get("age") or 0) < 18: 
-                skipped_reasons["under_18"] += 1
-                continue
             if other.get("name") in seen: 
                 skipped_reasons["duplicate_name"] += 1
                 continue
 
             seen.add(other.get("name"))
 
-            astrological_score = deep_compatibility(target_chart, other.get("chart"))
+            score_key = (target_features, other_features)
+            astrological_score = _score_cache.get(score_key)
+            if astrological_score is None:
+                astrological_score = compatibility_from_features(target_features, other_features)
+                _score_cache[score_key] = astrological_score
             ctype = classify_connection(astrological_score)
 
             # Parse relationship profile (support both snake_case and camelCase keys in DB)
@@ -300,27 +395,24 @@ async def soul_of_anlasana(user_id: str):
         print(f"🚫 [Matching] Skipped: {skipped_reasons}")
         print(f"✅ [Matching] Found {len(matches)} valid matches before sorting")
 
-        # Sort by most recent activity (last_active). Parse timestamps safely.
-        def _last_active_ts(item):
-            la = item.get("last_active")
-            if not la:
-                return 0
-            try:
-                return datetime.fromisoformat(la).timestamp()
-            except Exception:
-                try:
-                    return datetime.strptime(la, "%Y-%m-%dT%H:%M:%S%z").timestamp()
-                except Exception:
-                    return 0
-        
-        matches.sort(key=_last_active_ts, reverse=True)
-        final_matches = matches[:30]
+        # Page by keyset on most recent activity (last_active is already a timestamp).
+        # Only limit + 1 rows are needed, so select them instead of sorting everything.
+        if after:
+            after_key = (-after.last_active, after.id)
+            matches = [m for m in matches if match_sort_key(m) > after_key]
+
+        page = heapq.nsmallest(limit + 1, matches, key=match_sort_key)
+        final_matches = page[:limit]
+        has_more = len(page) > limit
+        next_cursor = encode_match_cursor(final_matches[-1]) if has_more else None
 
         print(f"🎯 [Matching] Returning {len(final_matches)} final matches for user {user_id}")
 
         return {
             "user_id": user_id,
-            "matches": final_matches
+            "matches": final_matches,
+            "next_cursor": next_cursor,
+            "has_more": has_more
         }
 
     except Exception as e:
@@ -331,8 +423,12 @@ async def soul_of_anlasana(user_id: str):
 @router.get("/sana/advice/{user_id}/{target_id}")
 async def get_sana_advice(user_id: str, target_id: str):
     try:
-        u1 = fetch_user(user_id)
-        u2 = fetch_user(target_id)
+        # Both lookups are independent; run them side by side off the event loop
+        advice_columns = "name, psych_map, chart"
+        u1, u2 = await asyncio.gather(
+            asyncio.to_thread(fetch_user, user_id, advice_columns),
+            asyncio.to_thread(fetch_user, target_id, advice_columns)
+        )
 
         if not u1 or not u2:
             raise HTTPException(status_code=404, detail="User not found")
@@ -346,7 +442,9 @@ async def get_sana_advice(user_id: str, target_id: str):
         chart1 = u1.get("chart")
         chart2 = u2.get("chart")
         try:
-            compatibility_score = deep_compatibility(chart1, chart2) if chart1 and chart2 else None
+            compatibility_score = compatibility_from_features(
+                cached_chart(user_id, chart1)[1], cached_chart(target_id, chart2)[1]
+            ) if chart1 and chart2 else None
         except Exception:
             compatibility_score = None
 
@@ -365,36 +463,13 @@ async def get_sana_advice(user_id: str, target_id: str):
         advice_text = None
         # Try to call OpenAI; if call fails, return a graceful fallback
         try:
-            if hasattr(openai_client, "chat") and hasattr(openai_client.chat, "completions"):
-                resp = openai_client.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=400
-                )
-                advice_text = None
-                if hasattr(resp, "choices") and len(resp.choices) > 0:
-                    choice = resp.choices[0]
-                    if hasattr(choice, "message") and hasattr(choice.message, "content"):
-                        advice_text = choice.message.content
-                    elif hasattr(choice, "text"):
-                        advice_text = choice.text
-            elif hasattr(openai_client, "responses"):
-                resp = openai_client.responses.create(
-                    model=OPENAI_MODEL,
-                    input=prompt,
-                    max_tokens=400
-                )
-                if hasattr(resp, "output") and len(resp.output) > 0:
-                    out = resp.output[0]
-                    if isinstance(out, dict) and out.get("content"):
-                        content = out.get("content")
-                        if isinstance(content, list) and len(content) > 0 and isinstance(content[0], dict):
-                            advice_text = content[0].get("text") or content[0].get("markdown")
-                        elif isinstance(content, str):
-                            advice_text = content
-                elif hasattr(resp, "choices") and len(resp.choices) > 0:
-                    ch = resp.choices[0]
-                    advice_text = getattr(ch, "text", None) or getattr(ch, "message", None)
+            resp = await aclient.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=400
+            )
+            if resp.choices:
+                advice_text = resp.choices[0].message.content
         except Exception as e:
             print("❌ [OpenAI] call failed:", e)
             advice_text = None
@@ -0,0 +1,49 @@
+-- One round trip for POST /api/premium/activate (premium/premium_activate.py):
+-- looks the user up, refuses duplicates and inserts the premium row atomically.
+-- Errors surface through PostgREST with these codes:
+--   P0002 -> user not found (404)
+--   23505 -> user already has premium (400)
+
+-- ON CONFLICT needs a unique index; dedupe premium_users first if this fails.
+create unique index if not exists premium_users_user_id_key
+    on premium_users (user_id);
+
+create or replace function activate_premium(
+    p_user_id text,
+    p_premium_type text,
+    p_price int,
+    p_days int,
+    p_badge text
+)
+returns setof premium_users
+language plpgsql
+as $$
+declare
+    v_name text;
+    v_email text;
+    v_row premium_users;
+begin
+    select u.name, u.email into v_name, v_email
+    from users u
+    where u.id = p_user_id;
+
+    if not found then
+        raise exception 'User not found' using errcode = 'P0002';
+    end if;
+
+    insert into premium_users (user_id, name, email, premium_type, start_date, end_date, price, badge)
+    values (
+        p_user_id, v_name, v_email, p_premium_type,
+        now(), now() + make_interval(days => p_days),
+        p_price, p_badge
+    )
+    on conflict (user_id) do nothing
+    returning * into v_row;
+
+    if v_row.user_id is null then
+        raise exception 'User already has premium' using errcode = '23505';
+    end if;
+
+    return next v_row;
+end;
+$$;
@@ -0,0 +1,39 @@
+-- Chat list for /get_user_chats in realtime_chat.py: the newest message per
+-- peer, joined to the peer's name and avatar, newest conversation first.
+-- Replaces shipping the user's whole message history to the API.
+
+-- Each side of "sender_id = uid or receiver_id = uid" gets an index;
+-- the sender side is covered by messages_pair_ts_id (messages_pair_index.sql).
+create index if not exists messages_receiver_ts
+    on messages (receiver_id, created_at desc);
+
+create or replace function get_user_chat_previews(uid text)
+returns table (
+    soulmate_id text,
+    soulmate_name text,
+    last_message text,
+    from_self boolean,
+    profile_url text
+)
+language sql stable
+as $$
+    select
+        p.peer::text,
+        coalesce(u.name, 'Unknown')::text,
+        p.content::text,
+        p.sender_id = uid,
+        u."profilePicUrl"::text
+    from (
+        select distinct on (peer) peer, content, sender_id, created_at
+        from (
+            select
+                case when m.sender_id = uid then m.receiver_id else m.sender_id end as peer,
+                m.content, m.sender_id, m.created_at
+            from messages m
+            where m.sender_id = uid or m.receiver_id = uid
+        ) x
+        order by peer, created_at desc
+    ) p
+    left join users u on u.id = p.peer
+    order by p.created_at desc;
+$$;
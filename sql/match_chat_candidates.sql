@@ -0,0 +1,32 @@
+-- Psych-vector top-K for /sana/chat match mode (sana_chat.try_rpc_match).
+-- The self-exclusion and the opposite-gender filter run in Postgres, and the
+-- rows carry the name/gender the handler reads, so nothing is dropped or
+-- re-fetched in Python.
+--
+-- target_gender_prefix is 'm' / 'f' (sana_chat.normalize_gender keys on the
+-- first letter) or null for no gender filter. Vectors are unit-length, so
+-- ranking uses the inner-product index from match_users_filtered.sql
+-- (run that first: it also defines set_hnsw_search).
+
+create or replace function match_chat_candidates(
+    query_vector vector(1536),
+    match_limit int,
+    exclude_id text,
+    target_gender_prefix text default null
+)
+returns table (id text, name text, gender text, similarity float)
+language plpgsql
+as $$
+begin
+    -- Filters apply after the HNSW scan; widen it (match_users_filtered.sql)
+    perform set_hnsw_search(match_limit);
+    return query
+    select u.id, u.name::text, u.gender::text, -(u.psych_vector <#> query_vector) as similarity
+    from users u
+    where u.psych_vector is not null
+      and u.id <> exclude_id
+      and (target_gender_prefix is null or lower(u.gender) like target_gender_prefix || '%')
+    order by u.psych_vector <#> query_vector
+    limit match_limit;
+end;
+$$;
@@ -0,0 +1,76 @@
+-- Psych-vector top-K for /soul_of_anlasana_2_1 with the candidate filters
+-- applied inside Postgres, so the API only receives rows it can use.
+-- Called from soul_of_anlasana_2_1.fetch_top_psych_matches.
+--
+-- min_similarity is a cheap necessary condition: rows whose cosine
+-- similarity is below it never reach the chart scoring in Python.
+-- Unknown (NULL) gender is kept, matching candidate_query.
+--
+-- psych_vector is stored L2-normalized (sana_psych_worker / backfill), so
+-- cosine similarity is just the inner product and the index answers with a
+-- single dot product per candidate. pgvector's <#> is the NEGATIVE inner
+-- product, hence the sign flips below.
+
+-- One-off: normalize vectors written before the API started doing it.
+update users
+set psych_vector = l2_normalize(psych_vector)
+where psych_vector is not null
+  and abs(vector_norm(psych_vector) - 1) > 1e-4;
+
+create index if not exists users_psych_vector_ip_hnsw
+    on users using hnsw (psych_vector vector_ip_ops);
+
+-- The legacy match_users RPC (still the fallback in
+-- soul_of_anlasana_2_1.fetch_top_psych_matches) orders by cosine distance,
+-- so its index stays until match_users moves to <#>. Recreated here for
+-- databases where an earlier version of this file dropped it.
+create index if not exists users_psych_vector_hnsw
+    on users using hnsw (psych_vector vector_cosine_ops);
+
+-- The signature gained min_similarity; drop the old overload so PostgREST
+-- does not see two candidates for the same call.
+drop function if exists match_users_filtered(vector, int, text, text);
+
+-- The HNSW scan hands back at most hnsw.ef_search rows (default 40), and the
+-- WHERE filters are applied after it, so a filtered top-K can come back far
+-- short of match_limit. Widen the search for the current transaction (every
+-- PostgREST call is its own transaction) and, on pgvector >= 0.8, let the
+-- index keep scanning until enough rows pass the filters.
+create or replace function set_hnsw_search(p_limit int)
+returns void
+language plpgsql
+as $$
+begin
+    perform set_config('hnsw.ef_search', least(greatest(p_limit * 4, 100), 1000)::text, true);
+    begin
+        perform set_config('hnsw.iterative_scan', 'strict_order', true);
+    exception when others then
+        null;  -- pgvector < 0.8: the wider ef_search above is all we get
+    end;
+end;
+$$;
+
+create or replace function match_users_filtered(
+    query_vector vector(1536),
+    match_limit int,
+    exclude_id text,
+    exclude_gender text,
+    min_similarity float default 0.3
+)
+returns table (id text, similarity float)
+language plpgsql
+as $$
+begin
+    perform set_hnsw_search(match_limit);
+    return query
+    select u.id, -(u.psych_vector <#> query_vector) as similarity
+    from users u
+    where u.psych_vector is not null
+      and u.id <> exclude_id
+      and u.gender is distinct from exclude_gender
+      and u.age >= 18
+      and u.psych_vector <#> query_vector <= -min_similarity
+    order by u.psych_vector <#> query_vector
+    limit match_limit;
+end;
+$$;
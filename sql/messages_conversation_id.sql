@@ -0,0 +1,17 @@
+-- Single equality key per conversation for /get_messages in realtime_chat.py,
+-- replacing the OR of the two sender/receiver directions.
+-- COLLATE "C" makes least/greatest compare by code point, matching Python's
+-- min()/max() on str in conversation_key().
+
+alter table messages
+    add column if not exists conversation_id text
+    generated always as (
+        least(sender_id::text collate "C", receiver_id::text collate "C")
+        || '_' ||
+        greatest(sender_id::text collate "C", receiver_id::text collate "C")
+    ) stored;
+
+-- id breaks ties in the (created_at, id) page cursor.
+drop index if exists messages_conversation_ts;
+create index if not exists messages_conversation_ts_id
+    on messages (conversation_id, created_at desc, id desc);
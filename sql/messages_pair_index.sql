@@ -0,0 +1,9 @@
+-- Supports the paginated /get_messages query in realtime_chat.py:
+--   (sender_id = a and receiver_id = b) or (sender_id = b and receiver_id = a)
+--   order by created_at desc, id desc limit n
+-- Each branch of the OR is an index range scan, newest first; id breaks
+-- ties in the (created_at, id) page cursor.
+
+drop index if exists messages_pair_ts;
+create index if not exists messages_pair_ts_id
+    on messages (sender_id, receiver_id, created_at desc, id desc);
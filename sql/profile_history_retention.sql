@@ -0,0 +1,33 @@
+-- Per-user caps for the append-only history tables (sana_history_tables.sql),
+-- matching the 200 candidates / 500 versions the users-row arrays used to
+-- keep. Inserts stay O(1); trimming happens here, in one pass per table,
+-- instead of on the request path.
+
+create or replace function prune_profile_history(
+    p_candidate_cap int default 200,
+    p_version_cap int default 500
+)
+returns void
+language sql
+as $$
+    delete from profile_candidates c
+    using (
+        select id,
+               row_number() over (partition by user_id, kind order by time desc, id desc) as rn
+        from profile_candidates
+    ) ranked
+    where c.id = ranked.id
+      and ranked.rn > p_candidate_cap;
+
+    delete from profile_versions v
+    using (
+        select id,
+               row_number() over (partition by user_id order by time desc, id desc) as rn
+        from profile_versions
+    ) ranked
+    where v.id = ranked.id
+      and ranked.rn > p_version_cap;
+$$;
+
+-- With pg_cron enabled (Supabase: Database -> Extensions):
+-- select cron.schedule('prune-profile-history', '17 * * * *', 'select prune_profile_history()');
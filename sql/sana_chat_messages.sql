@@ -0,0 +1,81 @@
+-- Sana chat history as one row per message instead of the users.chat_history
+-- array, so a turn is two inserts rather than a rewrite of the whole array.
+-- Readers page it with (user_id, time desc, id desc). Run after
+-- users_recent_chat.sql; users.chat_history is left in place (no longer
+-- written) and can be dropped once nothing reads it.
+
+create table if not exists sana_chat_messages (
+    id bigint generated always as identity primary key,
+    user_id text not null references users (id) on delete cascade,
+    role text not null,
+    name text,
+    content text not null default '',
+    time timestamptz not null default now()
+);
+
+-- A user message and Sana's reply share a timestamp; id keeps them in order.
+create index if not exists sana_chat_messages_user_time
+    on sana_chat_messages (user_id, time desc, id desc);
+
+-- One-off: copy existing histories (skips users already migrated).
+insert into sana_chat_messages (user_id, role, name, content, time)
+select u.id,
+       coalesce(e->>'role', 'user'),
+       e->>'name',
+       coalesce(e->>'content', ''),
+       coalesce((e->>'time')::timestamptz, now())
+from users u
+cross join lateral jsonb_array_elements(u.chat_history) with ordinality t(e, ord)
+where jsonb_typeof(u.chat_history) = 'array'
+  and not exists (select 1 from sana_chat_messages c where c.user_id = u.id)
+order by u.id, ord;
+
+-- Same signature as before so sana_chat.py does not change. p_history_cap is
+-- no longer used: the table keeps the full history.
+create or replace function append_sana_chat_turn(
+    p_user_id text,
+    p_messages jsonb,
+    p_memory jsonb,
+    p_history_cap int default 200,
+    p_memory_cap int default 400,
+    p_recent_cap int default 6
+)
+returns void
+language sql
+as $$
+    insert into sana_chat_messages (user_id, role, name, content, time)
+    select p_user_id,
+           coalesce(m->>'role', 'user'),
+           m->>'name',
+           coalesce(m->>'content', ''),
+           coalesce((m->>'time')::timestamptz, now())
+    from jsonb_array_elements(p_messages) with ordinality t(m, ord)
+    order by ord;
+
+    update users u
+    set recent_chat = (
+            select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+            from (
+                select e, ord
+                from jsonb_array_elements(coalesce(u.recent_chat, '[]'::jsonb) || p_messages)
+                     with ordinality t(e, ord)
+                order by ord desc
+                limit p_recent_cap
+            ) r
+        ),
+        memories = case
+            when jsonb_array_length(coalesce(u.memories, '[]'::jsonb)) < p_memory_cap
+            then coalesce(u.memories, '[]'::jsonb) || jsonb_build_array(p_memory)
+            else (
+                select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+                from (
+                    select e, ord
+                    from jsonb_array_elements(coalesce(u.memories, '[]'::jsonb) || jsonb_build_array(p_memory))
+                         with ordinality t(e, ord)
+                    order by ord desc
+                    limit p_memory_cap
+                ) m
+            )
+        end
+    where u.id = p_user_id;
+$$;
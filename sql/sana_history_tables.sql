@@ -0,0 +1,66 @@
+-- Append-only history for /sana/chat (sana_chat.py) and /sana/psych/update
+-- (sana_psych_worker.py). Each turn inserts or appends O(1) data instead of
+-- re-uploading the whole users.chat_history / memories / profile_* arrays.
+
+-- Extraction candidates and matchmaking results (users.profile_candidates
+-- used to hold both; `kind` tells them apart).
+create table if not exists profile_candidates (
+    id bigint generated always as identity primary key,
+    user_id text not null references users (id) on delete cascade,
+    kind text not null,
+    candidate jsonb not null,
+    time timestamptz not null default now()
+);
+
+create index if not exists profile_candidates_user_time
+    on profile_candidates (user_id, time desc);
+
+-- psych_map snapshots around every update (was users.profile_versions).
+create table if not exists profile_versions (
+    id bigint generated always as identity primary key,
+    user_id text not null references users (id) on delete cascade,
+    before jsonb,
+    after jsonb,
+    candidate jsonb,
+    time timestamptz not null default now()
+);
+
+create index if not exists profile_versions_user_time
+    on profile_versions (user_id, time desc);
+
+-- users.chat_history is still read by the natal prompt (main.py) and the
+-- psych backfill, so it stays on the row; the API sends only the new turn
+-- and Postgres appends and caps it in place.
+create or replace function append_sana_chat_turn(
+    p_user_id text,
+    p_messages jsonb,
+    p_memory jsonb,
+    p_history_cap int default 200,
+    p_memory_cap int default 400
+)
+returns void
+language sql
+as $$
+    update users u
+    set chat_history = (
+            select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+            from (
+                select e, ord
+                from jsonb_array_elements(coalesce(u.chat_history, '[]'::jsonb) || p_messages)
+                     with ordinality t(e, ord)
+                order by ord desc
+                limit p_history_cap
+            ) h
+        ),
+        memories = (
+            select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+            from (
+                select e, ord
+                from jsonb_array_elements(coalesce(u.memories, '[]'::jsonb) || jsonb_build_array(p_memory))
+                     with ordinality t(e, ord)
+                order by ord desc
+                limit p_memory_cap
+            ) m
+        )
+    where u.id = p_user_id;
+$$;
@@ -0,0 +1,62 @@
+-- /save_user (save_user.py) in one call: upsert the profile fields that were
+-- sent and hand out the next Cosmic ID (sana_id) if the user has none.
+-- The counter is bumped with a single UPDATE ... RETURNING, so concurrent
+-- signups can no longer read the same max_sana_id.
+--
+-- p_data holds only the fields the client sent (None values are dropped in
+-- Python); absent keys leave the column untouched.
+-- Returns {"status": "created" | "updated", "data": <users row>}.
+--
+-- settings is a generic key/value table: settings.value is text, holding
+-- the counter as a decimal string (save_user_rows reads it back through
+-- int()). It is cast to int to bump it and stored back as text.
+
+create or replace function save_user_profile(p_id text, p_data jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    r users;
+    v_exists boolean;
+    v_sana_id text;
+    v_next int;
+    v_row jsonb;
+begin
+    r := jsonb_populate_record(null::users, p_data);
+
+    select true, u.sana_id into v_exists, v_sana_id
+    from users u where u.id = p_id
+    for update;
+    v_exists := coalesce(v_exists, false);
+
+    if v_sana_id is null then
+        update settings
+        set value = (value::int + 1)::text
+        where key = 'max_sana_id'
+        returning value::int into v_next;
+        if v_next is not null then
+            v_sana_id := 'S' || v_next;
+        end if;
+    end if;
+
+    if v_exists then
+        update users u
+        set name = case when p_data ? 'name' then r.name else u.name end,
+            email = case when p_data ? 'email' then r.email else u.email end,
+            birthdate = case when p_data ? 'birthdate' then r.birthdate else u.birthdate end,
+            birthtime = case when p_data ? 'birthtime' then r.birthtime else u.birthtime end,
+            birthplace = case when p_data ? 'birthplace' then r.birthplace else u.birthplace end,
+            "profilePicUrl" = case when p_data ? 'profilePicUrl' then r."profilePicUrl" else u."profilePicUrl" end,
+            gender = case when p_data ? 'gender' then r.gender else u.gender end,
+            sana_id = coalesce(u.sana_id, v_sana_id)
+        where u.id = p_id
+        returning to_jsonb(u.*) into v_row;
+        return jsonb_build_object('status', 'updated', 'data', v_row);
+    end if;
+
+    insert into users as u (id, name, email, birthdate, birthtime, birthplace, "profilePicUrl", gender, sana_id)
+    values (p_id, r.name, r.email, r.birthdate, r.birthtime, r.birthplace, r."profilePicUrl", r.gender, v_sana_id)
+    returning to_jsonb(u.*) into v_row;
+    return jsonb_build_object('status', 'created', 'data', v_row);
+end;
+$$;
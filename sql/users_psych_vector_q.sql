@@ -0,0 +1,50 @@
+-- int8-quantized copy of users.psych_vector for the in-API match fallback
+-- (sana_chat.local_vector_match). Each vector keeps its own scale:
+--   psych_vector ~= psych_vector_q * psych_vector_scale
+-- Values fit in [-127, 127]; smallint is the narrowest integer array Postgres
+-- has, and as text it is ~3x smaller on the wire than the float vector.
+-- Run after match_users_filtered.sql (vectors are unit-length by then).
+
+alter table users add column if not exists psych_vector_q smallint[];
+alter table users add column if not exists psych_vector_scale real;
+
+-- Kept in sync by the database, so every writer of psych_vector (the psych
+-- worker, the backfill script) gets it for free.
+create or replace function quantize_psych_vector()
+returns trigger
+language plpgsql
+as $$
+declare
+    m real;
+begin
+    if new.psych_vector is null then
+        new.psych_vector_q := null;
+        new.psych_vector_scale := null;
+        return new;
+    end if;
+
+    select max(abs(x)) into m from unnest(new.psych_vector::real[]) x;
+    if m is null or m = 0 then
+        m := 1;
+    end if;
+
+    new.psych_vector_scale := m / 127;
+    new.psych_vector_q := array(
+        select round(x * 127 / m)::smallint
+        from unnest(new.psych_vector::real[]) with ordinality t(x, i)
+        order by i
+    );
+    return new;
+end;
+$$;
+
+drop trigger if exists users_quantize_psych_vector on users;
+create trigger users_quantize_psych_vector
+    before insert or update of psych_vector on users
+    for each row execute function quantize_psych_vector();
+
+-- One-off: fill existing rows (the no-op assignment fires the trigger).
+update users
+set psych_vector = psych_vector
+where psych_vector is not null
+  and psych_vector_q is null;
@@ -0,0 +1,78 @@
+-- The last few chat_history entries, kept on the users row so /sana/chat
+-- (sana_chat.py) reads a fixed-size column instead of the whole history.
+-- Run after sana_history_tables.sql.
+
+alter table users add column if not exists recent_chat jsonb;
+
+update users u
+set recent_chat = (
+    select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+    from (
+        select e, ord
+        from jsonb_array_elements(u.chat_history) with ordinality t(e, ord)
+        order by ord desc
+        limit 6
+    ) r
+)
+where u.recent_chat is null
+  and jsonb_typeof(u.chat_history) = 'array';
+
+-- Same as before plus p_recent_cap; drop the old overload so PostgREST does
+-- not see two candidates for the same call.
+drop function if exists append_sana_chat_turn(text, jsonb, jsonb, int, int);
+
+create or replace function append_sana_chat_turn(
+    p_user_id text,
+    p_messages jsonb,
+    p_memory jsonb,
+    p_history_cap int default 200,
+    p_memory_cap int default 400,
+    p_recent_cap int default 6
+)
+returns void
+language sql
+as $$
+    -- Below the cap the arrays are just concatenated; unnesting and
+    -- re-aggregating only happens once a column actually needs trimming.
+    update users u
+    set chat_history = case
+            when jsonb_array_length(coalesce(u.chat_history, '[]'::jsonb))
+                 + jsonb_array_length(p_messages) <= p_history_cap
+            then coalesce(u.chat_history, '[]'::jsonb) || p_messages
+            else (
+                select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+                from (
+                    select e, ord
+                    from jsonb_array_elements(coalesce(u.chat_history, '[]'::jsonb) || p_messages)
+                         with ordinality t(e, ord)
+                    order by ord desc
+                    limit p_history_cap
+                ) h
+            )
+        end,
+        recent_chat = (
+            select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+            from (
+                select e, ord
+                from jsonb_array_elements(coalesce(u.recent_chat, '[]'::jsonb) || p_messages)
+                     with ordinality t(e, ord)
+                order by ord desc
+                limit p_recent_cap
+            ) r
+        ),
+        memories = case
+            when jsonb_array_length(coalesce(u.memories, '[]'::jsonb)) < p_memory_cap
+            then coalesce(u.memories, '[]'::jsonb) || jsonb_build_array(p_memory)
+            else (
+                select coalesce(jsonb_agg(e order by ord), '[]'::jsonb)
+                from (
+                    select e, ord
+                    from jsonb_array_elements(coalesce(u.memories, '[]'::jsonb) || jsonb_build_array(p_memory))
+                         with ordinality t(e, ord)
+                    order by ord desc
+                    limit p_memory_cap
+                ) m
+            )
+        end
+    where u.id = p_user_id;
+$$;
@@ -1,7 +1,8 @@
-import os
+import asyncio
 from fastapi import FastAPI, HTTPException, APIRouter
 from pydantic import BaseModel
-from supabase import create_client
+from db import supabase_service as supabase  # service_role for writes
+from realtime_chat import invalidate_user_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,10 +11,6 @@ app = FastAPI()
 router = APIRouter()
 
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")  # Use service_role for write
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 
 # ----------- Request Body -----------
 class TokenUpdatePayload(BaseModel):
@@ -23,15 +20,20 @@ class TokenUpdatePayload(BaseModel):
 
 # ----------- API Endpoint -----------
 @router.post("/update_device_token")
-def update_device_token(payload: TokenUpdatePayload):
+async def update_device_token(payload: TokenUpdatePayload):
 
     # Update the token
-    response = supabase.table("users").update({
-        "device_token": payload.device_token
-    }).eq("id", payload.user_id).execute()
+    response = await asyncio.to_thread(
+        lambda: supabase.table("users").update({
+            "device_token": payload.device_token
+        }).eq("id", payload.user_id).execute()
+    )
 
     # If no rows updated → invalid user
     if len(response.data) == 0:
         raise HTTPException(status_code=404, detail="User not found")
 
+    # Pushes cache device tokens; make the next one use the new token
+    invalidate_user_cache(payload.user_id)
+
     return {"status": "success", "message": "Device token updated"}